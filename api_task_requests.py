@@ -1,40 +1,174 @@
 import requests
+import search_cache
+import track_record
+import http_session
 from custom_exception_check import CustomRequestExceptionCheck
+from pipeline import batches
 from urllib.parse import urlencode
 
 
+# maximum number of items that can be added with one request
+PLAYLIST_ADD_LIMIT = 100
+# maximum number of items in a search result page
+SEARCH_LIMIT = 50
+# maximum number of ids of one /v1/tracks request
+TRACKS_LIMIT = 50
+# maximum number of ids of one /v1/audio-features request
+AUDIO_FEATURES_LIMIT = 100
+
+
+def track_id(track_uri: str) -> str:
+    """
+    >>> track_id('spotify:track:6rqhFgbbKwnb9MLmUQDhG6')
+    '6rqhFgbbKwnb9MLmUQDhG6'
+    """
+    return track_uri.rpartition(':')[2]
+
+
 class Spochastify(CustomRequestExceptionCheck):
+    """
+    Search responses are answered from 'search_cache' (SearchCache object)
+    when one is given. The cache is not used by default.
+
+        spochastify = Spochastify(search_cache=search_cache.SearchCache())
+    """
+
+    def __init__(self, search_cache=None, session=None, timeout=None,
+                 scheduler=None):
+        super().__init__(session=session, timeout=timeout,
+                         scheduler=scheduler)
+        self.search_cache = search_cache
 
     def post_search_request(self, client_credential_access_token: str,
-                            search_word: str) -> requests.models.Response:
+                            search_word: str,
+                            market: str = None,
+                            limit: int = 3,
+                            offset: int = 0) -> requests.models.Response:
         """
         Argument :
             client_credential_access_token (str)
             search_word (str): a string for the spotify search request
+            market (str) : ISO 3166-1 alpha-2 country code, optional
+            limit  (int) : number of tracks in the result page (1-50)
+            offset (int) : index of the first track of the result page
 
         Returns  :
             r : requests.models.Response object
                    (OK:200 - The request has succeeded.)
+                or search_cache.CachedResponse object
+                   if the response is found in the search cache
 
         """
-        endpoint = "https://api.spotify.com/v1/search"
+        if not 1 <= limit <= SEARCH_LIMIT:
+            raise ValueError(f"limit must be between 1 and {SEARCH_LIMIT}")
+        search_type = 'track'
+        cache_key = None
+        if self.search_cache is not None:
+            cache_key = self.search_cache.make_key(search_word, search_type,
+                                                   limit, market, offset)
+            body = self.search_cache.get(cache_key)
+            if body is not None:
+                return search_cache.CachedResponse(body)
+
+        endpoint = f"{http_session.base_urls['api']}/v1/search"
         headers = {
             "Authorization": f'Bearer {client_credential_access_token}',
             "Accept": "application/json",
             "Content-Type": "application/json"
             }
-        data = {'q': search_word, 'type': 'track', 'limit': '3'}
+        data = {'q': search_word, 'type': search_type, 'limit': str(limit)}
+        if offset:
+            data['offset'] = str(offset)
+        if market:
+            data['market'] = market
         url = endpoint + '?' + urlencode(data)
         r = self.request_call_with_exception_check(
-                lambda: requests.get(url, headers=headers),
+                lambda: self.session.get(url, headers=headers,
+                                         timeout=self.timeout),
+                )
+        if cache_key is not None and r is not None and r.status_code == 200:
+            self.search_cache.put(cache_key, r.text)
+        return r
+
+    def get_next_search_page(self, client_credential_access_token: str,
+                             next_url: str) -> requests.models.Response:
+        """
+        Argument :
+            client_credential_access_token (str)
+            next_url (str) : r_search.json()['tracks']['next']
+
+        Returns  :
+            r : requests.models.Response object of the next result page
+        """
+        headers = {
+            "Authorization": f'Bearer {client_credential_access_token}',
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+            }
+        r = self.request_call_with_exception_check(
+                lambda: self.session.get(next_url, headers=headers,
+                                         timeout=self.timeout),
                 )
         return r
 
+    def iter_search_pages(self, client_credential_access_token: str,
+                          search_word: str,
+                          market: str = None,
+                          limit: int = SEARCH_LIMIT,
+                          offset: int = 0,
+                          max_pages: int = None):
+        """
+        Generator. Requests the result pages of a search lazily, the next
+        page is requested only when the previous one is consumed.
+
+        Argument :
+            check 'post_search_request'
+            max_pages (int) : stop after this many pages (None: all pages)
+
+        Yields   :
+            r_search : response object of each result page.
+                       Stops after the last page, an empty page or a
+                       failed request (the failed response or None is
+                       yielded last).
+        """
+        r_search = self.post_search_request(client_credential_access_token,
+                                            search_word, market=market,
+                                            limit=limit, offset=offset)
+        pages = 0
+        while True:
+            yield r_search
+            pages += 1
+            if r_search is None or r_search.status_code != 200:
+                return
+            if max_pages is not None and pages >= max_pages:
+                return
+            tracks = r_search.json()['tracks']
+            if not tracks['items'] or not tracks.get('next'):
+                return
+            r_search = self.get_next_search_page(
+                            client_credential_access_token, tracks['next'])
+
+    def iter_search_tracks(self, client_credential_access_token: str,
+                           search_word: str, **kwargs):
+        """
+        Generator. Yields the track items of all result pages of a search
+        one by one. Only one page is kept in memory.
+
+        Argument :
+            check 'iter_search_pages'
+        """
+        for r_search in self.iter_search_pages(client_credential_access_token,
+                                               search_word, **kwargs):
+            if r_search is None or r_search.status_code != 200:
+                return
+            yield from r_search.json()['tracks']['items']
+
     def get_list_of_tracks(self, r_search: requests.models.Response) -> list:
         """
         Argument :
             r_search (requests.models.Response object) :
                 response object of the 'post_search_request' method
+                (or search_cache.CachedResponse object)
 
         Returns  :
             returned_items_list (list)  : If tracks are found in the search,
@@ -73,7 +207,8 @@ class Spochastify(CustomRequestExceptionCheck):
             r : requests.models.Response object
                     (OK:201 - The request has succeeded.)
         """
-        endpoint = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+        endpoint = (f"{http_session.base_urls['api']}"
+                    f"/v1/playlists/{playlist_id}/tracks")
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {access_token_with_scope}"
@@ -81,10 +216,127 @@ class Spochastify(CustomRequestExceptionCheck):
         data = {"uris": track_uri}
         url = endpoint + '?' + urlencode(data)
         r = self.request_call_with_exception_check(
-                lambda: requests.post(url, headers=headers),
+                lambda: self.session.post(url, headers=headers,
+                                          timeout=self.timeout),
+                # not idempotent, a 5xx add is not sent again
+                idempotent=False,
+                )
+        return r
+
+    def add_tracks_to_playlist(self, access_token_with_scope: str,
+                               track_uris,
+                               playlist_id: str,
+                               chunk_size: int = PLAYLIST_ADD_LIMIT) -> list:
+        """
+        Batch mode of 'add_track_to_playlist'.
+
+        Argument :
+            access_token_with_scope (str)
+            track_uris (iterable) : track_uris of Spotify tracks
+            playlist_id (str)
+            chunk_size (int)      : uris per request, max. 100 (API limit)
+
+        Returns  :
+            chunk_results (list) : one dict per sent chunk, in order
+                {
+                    'chunk': 0,                   # index of the chunk
+                    'track_uris': [...],
+                    'status_code': 201,           # None if exception catched
+                    'snapshot_id': "JbtmHBDBAY...",
+                    'response': r                 # requests.models.Response
+                }
+
+        Chunks are sent in order as json body. The playlist snapshot_id
+        returned by each request is recorded. If a chunk fails, the remaining
+        chunks are not sent; the last snapshot_id in the results is the
+        playlist version that contains all of the added chunks.
+        """
+        if not 0 < chunk_size <= PLAYLIST_ADD_LIMIT:
+            raise ValueError(
+                f"chunk_size must be between 1 and {PLAYLIST_ADD_LIMIT}")
+        endpoint = (f"{http_session.base_urls['api']}"
+                    f"/v1/playlists/{playlist_id}/tracks")
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {access_token_with_scope}"
+            }
+        chunk_results = []
+        for i, chunk in enumerate(batches(track_uris, chunk_size)):
+            r = self.request_call_with_exception_check(
+                    lambda: self.session.post(endpoint, json={"uris": chunk},
+                                              headers=headers,
+                                              timeout=self.timeout),
+                    idempotent=False,
+                    )
+            status_code = None if r is None else r.status_code
+            snapshot_id = None
+            if status_code == 201:
+                snapshot_id = r.json().get('snapshot_id')
+            chunk_results.append({
+                'chunk': i,
+                'track_uris': chunk,
+                'status_code': status_code,
+                'snapshot_id': snapshot_id,
+                'response': r
+                })
+            if status_code != 201:
+                break
+        return chunk_results
+
+    def get_ids_request(self, client_credential_access_token: str,
+                        path: str, track_ids: list,
+                        id_limit: int) -> requests.models.Response:
+        """
+        GET request of a multi-id endpoint, e.g. /v1/tracks?ids=id1,id2,...
+        """
+        if not 0 < len(track_ids) <= id_limit:
+            raise ValueError(f"between 1 and {id_limit} ids per request")
+        endpoint = f"{http_session.base_urls['api']}{path}"
+        headers = {
+            "Authorization": f'Bearer {client_credential_access_token}',
+            "Accept": "application/json",
+            "Content-Type": "application/json"
+            }
+        url = endpoint + '?' + urlencode({'ids': ','.join(track_ids)})
+        r = self.request_call_with_exception_check(
+                lambda: self.session.get(url, headers=headers,
+                                         timeout=self.timeout),
                 )
         return r
 
+    def get_several_tracks(self, client_credential_access_token: str,
+                           track_ids: list) -> requests.models.Response:
+        """
+        Argument :
+            client_credential_access_token (str)
+            track_ids (list) : up to 50 Spotify track ids (not uris)
+
+        Returns  :
+            r : requests.models.Response object
+                   (OK:200 - The request has succeeded.)
+                r.json()['tracks'] has one full track object per id in
+                request order, null if the id is not found
+        """
+        return self.get_ids_request(client_credential_access_token,
+                                    "/v1/tracks", track_ids, TRACKS_LIMIT)
+
+    def get_several_audio_features(self, client_credential_access_token: str,
+                                   track_ids: list) -> requests.models.Response:
+        """
+        Argument :
+            client_credential_access_token (str)
+            track_ids (list) : up to 100 Spotify track ids (not uris)
+
+        Returns  :
+            r : requests.models.Response object
+                   (OK:200 - The request has succeeded.)
+                r.json()['audio_features'] has one audio features object
+                per id in request order, null if there is none
+        """
+        return self.get_ids_request(client_credential_access_token,
+                                    "/v1/audio-features", track_ids,
+                                    AUDIO_FEATURES_LIMIT)
+
     def extract_track_info(self, random_track_item: dict) -> dict:
         """
             Argument :
@@ -100,38 +352,30 @@ class Spochastify(CustomRequestExceptionCheck):
                         'track_uri': track_uri
                     }
         """
-        try:
-            artist_name = random_track_item['artists'][0]['name']
-        except KeyError:
-            artist_name = 'Not Available'
-
-        try:
-            album_name = random_track_item['album']['name']
-        except KeyError:
-            album_name = 'Not Available'
-
-        try:
-            track_name = random_track_item['name']
-        except KeyError:
-            track_name = 'Not Available'
-
-        try:
-            track_external_urls = random_track_item['external_urls']['spotify']
-        except KeyError:
-            track_external_urls = 'Not Available'
-
-        try:
-            track_uri = random_track_item['uri']  #to add into playlist
-        except KeyError:
-            track_uri = 'Not Available'
-
-        track_details = {
-            'artist_name': artist_name,
-            'album_name': album_name,
-            'track_name': track_name,
-            'track_external_urls': track_external_urls,
-            'track_uri': track_uri
-            }
+        return track_record.Track.from_item(random_track_item)._asdict()
 
-        return track_details
+    def extract_many(self, returned_items_list: list) -> list:
+        """
+            Argument :
+                returned_items_list (list) : track items of a search result
+
+            Returns  :
+                tracks (list) : track_record.Track records
+                                (same fields as 'extract_track_info')
+        """
+        return track_record.extract_many(returned_items_list)
 
+    def get_tracks(self, r_search: requests.models.Response) -> list:
+        """
+            Argument :
+                r_search : response object of the 'post_search_request'
+
+            Returns  :
+                tracks (list) : track_record.Track records of the result page.
+                                The decoded item dicts are released after the
+                                projection.
+        """
+        tracks = track_record.extract_many(r_search.json()['tracks']['items'])
+        if hasattr(r_search, 'release'):
+            r_search.release()
+        return tracks
@@ -1,8 +1,206 @@
-import hidden
 import requests
 import base64
+import json
+import os
+import threading
+import time
 from urllib.parse import urlencode
-from custom_exception_check import CustomRequestExceptionCheck
+import http_session
+from custom_exception_check import (CustomRequestExceptionCheck,
+                                    rejected_token_handlers)
+
+try:
+    import fcntl
+except ImportError:   # not available on Windows, in-process locking only
+    fcntl = None
+
+
+class TokenCache(object):
+    """
+    Access tokens expire in 3600 seconds. TokenCache keeps the received
+    tokens in memory and in a local json file, so one token can be reused by
+    many DAG runs and by concurrent workers until it is about to expire.
+
+    Cache key : "<grant_type>:<scope>"
+        e.g. "client_credentials:"
+             "refresh_token:playlist-modify-public"
+
+    Cache file content :
+        {
+            "client_credentials:": {
+                "access_token": "NgCXRKc...MzYjw",
+                "expires_at": 1623695091.2
+            }
+        }
+
+    A token is handed back only if it is still valid for at least
+    'refresh_margin' seconds. Otherwise it is treated as expired and a new
+    token is requested.
+
+    The file is read and written under an exclusive file lock (fcntl), so
+    when several workers start at the same time only one of them requests a
+    new token and the others reuse it.
+
+    A token that the API refuses with 401 (revoked, credentials changed)
+    is removed by 'discard_token' (check Tokens), so the next run requests
+    a new one instead of reusing it until it expires.
+    """
+
+    def __init__(self, path="token_cache.json", refresh_margin=60):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(grant_type: str, scope: str = "") -> str:
+        return f"{grant_type}:{scope}"
+
+    def _is_valid(self, entry: dict) -> bool:
+        return entry["expires_at"] - self.refresh_margin > time.time()
+
+    def _read_file(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_file(self, tokens: dict) -> None:
+        # write to a temporary file first, readers never see a partial file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(tokens, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def _file_lock(self):
+        """Returns an open lock file (exclusively locked) or None."""
+        if fcntl is None or not self.path:
+            return None
+        lock_file = open(f"{self.path}.lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def get(self, key: str):
+        """
+        Returns  :
+            access_token (str) : if a still valid token is cached
+            None               : else
+        """
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None or not self._is_valid(entry):
+                entry = self._read_file().get(key) if self.path else None
+                if entry is None or not self._is_valid(entry):
+                    return None
+                self._tokens[key] = entry
+            return entry["access_token"]
+
+    def store(self, key: str, token_json: dict) -> str:
+        """
+        Argument :
+            key        (str)  : cache key, check 'make_key'
+            token_json (dict) : json body of the token response
+                                ("access_token", "expires_in", ...)
+
+        Returns  :
+            access_token (str)
+        """
+        entry = {
+            "access_token": token_json["access_token"],
+            "expires_at": time.time() + token_json.get("expires_in", 3600)
+            }
+        with self._lock:
+            self._tokens[key] = entry
+            if self.path:
+                tokens = self._read_file()
+                tokens[key] = entry
+                self._write_file(tokens)
+        return entry["access_token"]
+
+    def invalidate(self, key: str, access_token: str = None) -> None:
+        """
+        Removes the cached token of 'key' from the memory and the file. If
+        'access_token' is given, the entry is removed only if it has this
+        token (a newer token stored by another worker is kept).
+        """
+        def stale(entry):
+            return entry is not None and (
+                access_token is None or entry["access_token"] == access_token)
+
+        with self._lock:
+            if stale(self._tokens.get(key)):
+                del self._tokens[key]
+            if not self.path:
+                return
+            lock_file = self._file_lock()
+            try:
+                tokens = self._read_file()
+                if stale(tokens.get(key)):
+                    del tokens[key]
+                    self._write_file(tokens)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+    def discard_token(self, access_token: str) -> None:
+        """Invalidates the keys that have 'access_token'."""
+        with self._lock:
+            keys = {key for key, entry in self._tokens.items()
+                    if entry["access_token"] == access_token}
+            if self.path:
+                keys.update(key for key, entry in self._read_file().items()
+                            if entry.get("access_token") == access_token)
+            for key in keys:
+                self.invalidate(key, access_token)
+
+    def get_or_request(self, key: str, request_token):
+        """
+        Argument :
+            key           (str)      : cache key, check 'make_key'
+            request_token (function) : token request method of Tokens class
+
+        Returns  :
+            (access_token, None) : if the token is served from the cache
+            (access_token, r)    : if a new token is received
+            (None, r)            : if the token request is failed.
+                                   r is None or requests.models.Response
+        """
+        access_token = self.get(key)
+        if access_token is not None:
+            return access_token, None
+        with self._lock:
+            lock_file = self._file_lock()
+            try:
+                # another worker may have refreshed the token meanwhile
+                access_token = self.get(key)
+                if access_token is not None:
+                    return access_token, None
+                r = request_token()
+                if r is None or r.status_code != 200:
+                    return None, r
+                return self.store(key, r.json()), r
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+
+
+# shared by all Tokens instances of the process
+default_token_cache = TokenCache()
+
+
+def get_credential(name: str) -> str:
+    """
+    Argument :
+        name (str) : 'client_id', 'client_secret' or 'refresh_token'
+
+    Returns  :
+        the value in hidden.py. hidden is imported on the first call, not
+        when auth is imported (e.g. while the Airflow DAG file is parsed).
+    """
+    import hidden
+    return getattr(hidden, name)
 
 
 class Tokens(CustomRequestExceptionCheck):
@@ -54,18 +252,42 @@ class Tokens(CustomRequestExceptionCheck):
            a request_object. headers['access_token'] has the access token.
            !! Only this token can be used to add tracks into playlist.
 
+
+    Cached tokens :
+
+        -> Call "get_cached_client_credential_access_token" or
+           "get_cached_access_token_with_scope" methods.
+           These methods return (access_token, r) tuples. A token is
+           requested only if there is no still valid token in the TokenCache.
+
     """
 
-    def get_base64encoded(self, client_id=hidden.client_id,
-                          client_secret=hidden.client_secret) -> str:
+    scope = "playlist-modify-public"
+
+    def __init__(self, token_cache=None, session=None, timeout=None,
+                 scheduler=None):
+        super().__init__(session=session, timeout=timeout,
+                         scheduler=scheduler)
+        self.token_cache = token_cache or default_token_cache
+        # tokens refused with 401 by any request are removed from the cache
+        if self.token_cache.discard_token not in rejected_token_handlers:
+            rejected_token_handlers.append(self.token_cache.discard_token)
+
+    def get_base64encoded(self, client_id: str = None,
+                          client_secret: str = None) -> str:
         """
         Arguments :
             client_id     (str) : Developer's client_id
             client_secret (str) : Developer's client_secret
+                                  (default: the values in hidden.py)
 
         Returns :
             Authorization Value : Basic <base64 encoded client_id:client_secret>
         """
+        if client_id is None:
+            client_id = get_credential("client_id")
+        if client_secret is None:
+            client_secret = get_credential("client_secret")
         auth_value = f"{client_id}:{client_secret}"
         auth_value_conversion = base64.b64encode(auth_value.encode())
         return auth_value_conversion.decode()
@@ -91,7 +313,7 @@ class Tokens(CustomRequestExceptionCheck):
                 "expires_in": 3600,
             }
         """
-        endpoint = "https://accounts.spotify.com/api/token"
+        endpoint = f"{http_session.base_urls['accounts']}/api/token"
         data = {
             "grant_type": "client_credentials"
             }
@@ -99,7 +321,8 @@ class Tokens(CustomRequestExceptionCheck):
             "Authorization": f"Basic {self.get_base64encoded()}"
             }
         r = self.request_call_with_exception_check(
-                lambda: requests.post(endpoint, data=data, headers=headers),
+                lambda: self.session.post(endpoint, data=data, headers=headers,
+                                          timeout=self.timeout),
                 )
         return r
 
@@ -125,16 +348,16 @@ class Tokens(CustomRequestExceptionCheck):
                         in order to obtain the access token that requires for
                         adding tracks to playlist of the user.
         """
-        endpoint = "https://accounts.spotify.com/authorize"
+        endpoint = f"{http_session.base_urls['accounts']}/authorize"
         data = {
-            "client_id": hidden.client_id,
+            "client_id": get_credential("client_id"),
             "response_type": "code",
             "redirect_uri": "https://www.spotify.com/callback",
-            "scope": "playlist-modify-public"
+            "scope": self.scope
             }
         url = endpoint + "?" + urlencode(data)
         r = self.request_call_with_exception_check(
-                lambda: requests.get(url),
+                lambda: self.session.get(url, timeout=self.timeout),
                 )
         return r.url
 
@@ -178,7 +401,7 @@ class Tokens(CustomRequestExceptionCheck):
                 "refresh_token": "NgAagA...Um_SHo"
             }
         """
-        endpoint = "https://accounts.spotify.com/api/token"
+        endpoint = f"{http_session.base_urls['accounts']}/api/token"
         data = {
             "grant_type": "authorization_code",
             "code": code,
@@ -188,7 +411,8 @@ class Tokens(CustomRequestExceptionCheck):
             "Authorization": f"Basic {self.get_base64encoded()}"
             }
         r = self.request_call_with_exception_check(
-                lambda: requests.post(endpoint, data=data, headers=headers),
+                lambda: self.session.post(endpoint, data=data, headers=headers,
+                                          timeout=self.timeout),
                 )
         return r
 
@@ -223,15 +447,43 @@ class Tokens(CustomRequestExceptionCheck):
                  "expires_in": 3600
             }
         """
-        endpoint = "https://accounts.spotify.com/api/token"
+        endpoint = f"{http_session.base_urls['accounts']}/api/token"
         data = {
             "grant_type": "refresh_token",
-            "refresh_token": hidden.refresh_token
+            "refresh_token": get_credential("refresh_token")
             }
         headers = {
             "Authorization": f"Basic {self.get_base64encoded()}"
             }
         r = self.request_call_with_exception_check(
-                lambda: requests.post(endpoint, data=data, headers=headers),
+                lambda: self.session.post(endpoint, data=data, headers=headers,
+                                          timeout=self.timeout),
                 )
         return r
+
+    def get_cached_client_credential_access_token(self) -> tuple:
+        """
+        Purpose :
+            Reusing the client credential access token until it expires.
+
+        Returns :
+            (access_token, None) : token is served from the cache
+            (access_token, r)    : new token is received
+            (None, r)            : request is failed. r is None if an
+                                   exception is catched, else response object
+        """
+        key = self.token_cache.make_key("client_credentials")
+        return self.token_cache.get_or_request(
+                    key, self.get_client_credential_access_token)
+
+    def get_cached_access_token_with_scope(self) -> tuple:
+        """
+        Purpose :
+            Reusing the access token with scope until it expires.
+
+        Returns :
+            Check "get_cached_client_credential_access_token" method.
+        """
+        key = self.token_cache.make_key("refresh_token", self.scope)
+        return self.token_cache.get_or_request(
+                    key, self.get_access_token_with_scope)
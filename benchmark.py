@@ -0,0 +1,444 @@
+"""
+Offline benchmark of the request pipeline.
+
+Starts mock_spotify_server on localhost, points the base urls of the
+application at it and drives Tokens, Spochastify, run_spotify_app,
+database_update and enrichment end to end in a temporary working directory
+(token cache, search cache, log and database files are not touched).
+Reports the requests per second and the latency percentiles of each stage
+and the database rows per second.
+
+    python benchmark.py
+    python benchmark.py --latency 0.03 --error-rate 0.02 --rate-limit-rate 0.01
+    python benchmark.py --requests 500 --concurrency 16 --json
+
+'--imports' measures the import cost of the modules loaded when the
+Airflow scheduler parses spotify_app_dag.py:
+
+    python benchmark.py --imports
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import auth
+import api_task_requests
+import custom_exception_check
+import database_update
+import enrichment
+import http_session
+import metrics
+import rate_limiter
+import spotify_app
+from mock_spotify_server import MockSpotifyServer, spotify_id
+from query_generator import random_string
+from track_record import Track
+
+
+# import cost of the modules loaded by an Airflow DAG parse.
+# playlist_config is what spotify_app_dag.py imports now, spotify_app is
+# what it imported before.
+IMPORT_MODULES = ('playlist_config', 'spotify_app', 'spotify_app_dag')
+
+
+def set_benchmark_credentials() -> list:
+    """
+    The stand-in server accepts any credentials.
+
+    Returns  :
+        names (list) : attributes of the hidden module that are set, removed
+                       again by 'clear_benchmark_credentials'
+    """
+    import hidden
+    names = [name for name in ('client_id', 'client_secret', 'refresh_token')
+             if not hasattr(hidden, name)]
+    for name in names:
+        setattr(hidden, name, 'benchmark')
+    return names
+
+
+def clear_benchmark_credentials(names: list) -> None:
+    """Removes the attributes set by 'set_benchmark_credentials'."""
+    import hidden
+    for name in names:
+        if getattr(hidden, name, None) == 'benchmark':
+            delattr(hidden, name)
+
+
+def is_added(result) -> bool:
+    """True if 'result' of spotify_app.run_spotify_app is an added track."""
+    return (isinstance(result, tuple) and isinstance(result[0], str)
+            and result[0].startswith('spotify:track:'))
+
+
+def import_time(module: str, repeat: int = 5) -> dict:
+    """
+    Imports 'module' in 'repeat' fresh interpreters (python -X importtime)
+    in an empty working directory.
+
+    Returns  :
+        {
+            'module': module,
+            'median_ms': float,       # cumulative import time
+            'modules_loaded': int,    # modules imported by the import
+            'created_files': [...],   # files written as a side effect
+            'error': str              # only if the import is failed
+        }
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [package_dir, os.environ.get('PYTHONPATH')])))
+    timings = []
+
+    def run(code):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=tmp, env=env, capture_output=True, text=True)
+        lines = [line for line in process.stderr.splitlines()
+                 if line.startswith('import time:')
+                 and not line.endswith('| imported package')]
+        return process, lines
+
+    with tempfile.TemporaryDirectory(prefix='spotify_import_') as tmp:
+        # modules imported by the interpreter startup
+        startup_modules = len(run('pass')[1])
+        for i in range(repeat):
+            process, lines = run(f'import {module}')
+            if process.returncode != 0:
+                return {'module': module,
+                        'error': process.stderr.strip().splitlines()[-1]}
+            # import time: self [us] | cumulative | imported package
+            for line in lines:
+                self_us, cumulative_us, name = line[12:].split('|')
+                if name.strip() == module:
+                    timings.append(int(cumulative_us) / 1000)
+        created_files = sorted(os.listdir(tmp))
+    return {
+        'module': module,
+        'median_ms': round(statistics.median(timings), 2),
+        'modules_loaded': len(lines) - startup_modules,
+        'created_files': created_files,
+        }
+
+
+def timed_stage(name: str, f, operations: int) -> dict:
+    """
+    Runs f() with fresh request metrics.
+
+    Returns  :
+        {'stage', 'operations', 'seconds', 'per_sec', 'latency'}
+        latency is metrics.RequestMetrics.summary() of the stage
+    """
+    metrics.request_metrics = metrics.RequestMetrics()
+    start = time.perf_counter()
+    result = f()
+    seconds = time.perf_counter() - start
+    return {
+        'stage': name,
+        'operations': operations,
+        'seconds': round(seconds, 4),
+        'per_sec': round(operations / seconds, 1) if seconds else 0.0,
+        'latency': metrics.request_metrics.summary(),
+        'result': result,
+        }
+
+
+def fake_tracks(count: int) -> list:
+    tracks = []
+    for i in range(count):
+        track_id = spotify_id(f"benchmark:{i}")
+        tracks.append(Track(f"Artist {i % 1000}", f"Album {i % 5000}",
+                            f"Track {i}",
+                            f"https://open.spotify.com/track/{track_id}",
+                            f"spotify:track:{track_id}"))
+    return tracks
+
+
+class Benchmark(object):
+    """
+    Argument :
+        requests (int)    : requests of each request stage
+        concurrency (int) : threads of the concurrent search stage
+        runs (int)        : run_spotify_app calls
+        rows (int)        : rows of the database stages
+        search_limit (int): tracks per search page (1-50)
+    """
+
+    def __init__(self, requests: int = 200, concurrency: int = 8,
+                 runs: int = 50, rows: int = 10000, search_limit: int = 50):
+        self.requests = requests
+        self.concurrency = concurrency
+        self.runs = runs
+        self.rows = rows
+        self.search_limit = search_limit
+
+    def stage_tokens(self) -> dict:
+        token = auth.Tokens()
+
+        def f():
+            return sum(bool(token.get_client_credential_access_token())
+                       for i in range(self.requests))
+        return timed_stage('token', f, self.requests)
+
+    def stage_search(self, token: str) -> dict:
+        spochastify = api_task_requests.Spochastify()
+
+        def f():
+            return sum(bool(spochastify.post_search_request(
+                                token, random_string(),
+                                limit=self.search_limit))
+                       for i in range(self.requests))
+        return timed_stage('search', f, self.requests)
+
+    def stage_concurrent_search(self, token: str) -> dict:
+        spochastify = api_task_requests.Spochastify()
+
+        def search(i):
+            r = spochastify.post_search_request(token, random_string(),
+                                                limit=self.search_limit)
+            return bool(r)
+
+        def f():
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                return sum(executor.map(search, range(self.requests)))
+        return timed_stage(f'search x{self.concurrency}', f, self.requests)
+
+    def stage_playlist_add(self, token: str) -> dict:
+        spochastify = api_task_requests.Spochastify()
+        uris = [track.track_uri for track in fake_tracks(self.requests)]
+
+        def f():
+            return sum(bool(spochastify.add_track_to_playlist(
+                                token, uri, spotify_app.get_playlist_id()))
+                       for uri in uris)
+        return timed_stage('playlist add', f, self.requests)
+
+    def stage_playlist_add_batch(self, token: str) -> dict:
+        spochastify = api_task_requests.Spochastify()
+        uris = [track.track_uri for track in fake_tracks(self.rows)]
+
+        def f():
+            chunks = spochastify.add_tracks_to_playlist(
+                            token, uris, spotify_app.get_playlist_id())
+            return sum(len(chunk['track_uris']) for chunk in chunks
+                       if chunk['status_code'] == 201)
+        return timed_stage('playlist add (batch, uris)', f, len(uris))
+
+    def stage_run_spotify_app(self) -> dict:
+        def f():
+            # (track_uri, search_word) if a track is added; a failed run
+            # returns a response object or (r_search, search_word)
+            return sum(is_added(spotify_app.run_spotify_app(
+                                    search_limit=self.search_limit))
+                       for i in range(self.runs))
+        return timed_stage('run_spotify_app', f, self.runs)
+
+    def stage_update_db(self, db_path: str) -> dict:
+        tracks = fake_tracks(min(self.rows, 1000))
+        dt_now = datetime.now(timezone.utc)
+
+        def f():
+            # one transaction per track, as the DAG run writes
+            for track in tracks:
+                with database_update.TrackWriter(db_path) as writer:
+                    writer.write(track._asdict(), dt_now)
+            return len(tracks)
+        return timed_stage('update_db (rows)', f, len(tracks))
+
+    def stage_track_writer(self, db_path: str) -> dict:
+        start_time = datetime.now(timezone.utc)
+        rows = [(track, start_time + timedelta(seconds=i))
+                for i, track in enumerate(fake_tracks(self.rows))]
+
+        def f():
+            with database_update.TrackWriter(db_path) as writer:
+                return writer.write_many(rows)
+        return timed_stage('TrackWriter.write_many (rows)', f, len(rows))
+
+    def stage_enrichment(self, db_path: str) -> dict:
+        """Enriches the Random_Tracks rows of 'db_path' (batch endpoints)."""
+        enricher = enrichment.Enricher(concurrency=self.concurrency,
+                                       db_path=db_path)
+
+        def f():
+            return enricher.run()
+        with database_update.EnrichmentWriter(db_path) as writer:
+            tracks = len(writer.missing('Track_Details'))
+        return timed_stage('enrichment (tracks)', f, tracks)
+
+    def run(self) -> list:
+        token = auth.Tokens()
+        client_credential_access_token, r = \
+            token.get_cached_client_credential_access_token()
+        access_token_with_scope, r = token.get_cached_access_token_with_scope()
+        if client_credential_access_token is None or \
+                access_token_with_scope is None:
+            raise RuntimeError("mock server did not return an access token")
+        return [
+            self.stage_tokens(),
+            self.stage_search(client_credential_access_token),
+            self.stage_concurrent_search(client_credential_access_token),
+            self.stage_playlist_add(access_token_with_scope),
+            self.stage_playlist_add_batch(access_token_with_scope),
+            self.stage_run_spotify_app(),
+            self.stage_update_db('benchmark_update_db.sql'),
+            self.stage_track_writer('benchmark_track_writer.sql'),
+            self.stage_enrichment('benchmark_track_writer.sql'),
+            ]
+
+
+def run_benchmark(server: MockSpotifyServer, benchmark: Benchmark,
+                  rate: float = 10000.0) -> dict:
+    """
+    Runs the stages against the server in a temporary working directory,
+    the log records are written to a log file there. The credentials, the
+    base urls, the session config, the shared scheduler, the token cache
+    path, the request metrics and the log config are restored afterwards.
+
+    Argument :
+        rate (float) : requests per second of the shared scheduler
+    """
+    credentials = set_benchmark_credentials()
+    base_url = server.start()
+    base_urls = dict(http_session.base_urls)
+    session_config = dict(http_session.session_config)
+    scheduler = rate_limiter.get_scheduler()
+    token_cache_path = auth.default_token_cache.path
+    request_metrics = metrics.request_metrics
+    log_config = dict(custom_exception_check.log_config)
+    logging_configured = custom_exception_check.logging_configured()
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(prefix='spotify_benchmark_') as tmp:
+            os.chdir(tmp)
+            try:
+                custom_exception_check.configure_logging(
+                    path=os.path.join(tmp, custom_exception_check.LOG_PATH))
+                http_session.configure_base_urls(accounts=base_url,
+                                                 api=base_url)
+                http_session.configure_session(pool_maxsize=max(
+                    benchmark.concurrency, session_config['pool_maxsize']))
+                rate_limiter.configure_scheduler(rate=rate, capacity=rate,
+                                                 backoff_base=0.01)
+                auth.default_token_cache.path = 'token_cache.json'
+                stages = benchmark.run()
+            finally:
+                # the log file of the run is closed before the directory is
+                # removed, the previous file is opened again from 'cwd'
+                os.chdir(cwd)
+                if logging_configured:
+                    custom_exception_check.configure_logging(**log_config)
+                else:
+                    custom_exception_check.stop_logging()
+                    custom_exception_check.log_config.update(log_config)
+    finally:
+        os.chdir(cwd)
+        clear_benchmark_credentials(credentials)
+        http_session.configure_base_urls(**base_urls)
+        http_session.configure_session(**session_config)
+        rate_limiter.set_scheduler(scheduler)
+        auth.default_token_cache.path = token_cache_path
+        metrics.request_metrics = request_metrics
+        server.stop()
+    return {
+        'server': {
+            'latency': server.latency,
+            'error_rate': server.error_rate,
+            'rate_limit_rate': server.rate_limit_rate,
+            'markets_per_item': server.markets_per_item,
+            'requests': dict(server.requests),
+            },
+        'stages': stages,
+        }
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{'stage':32} {'ops':>7} {'seconds':>9} {'ops/sec':>10} "
+             f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"]
+    for stage in report['stages']:
+        latency = stage['latency']
+        count = sum(endpoint['count'] for endpoint in latency.values())
+        # request count weighted percentiles of the endpoints of the stage
+        percentiles = [
+            sum(endpoint[p] * endpoint['count'] for endpoint in latency.values())
+            / count if count else 0.0
+            for p in ('p50', 'p95', 'p99')]
+        lines.append(f"{stage['stage']:32} {stage['operations']:7d} "
+                     f"{stage['seconds']:9.3f} {stage['per_sec']:10.1f} "
+                     + " ".join(f"{p:8.1f}" for p in percentiles))
+    lines += ["", "mock server requests: " + ", ".join(
+        f"{endpoint}={count}"
+        for endpoint, count in sorted(report['server']['requests'].items()))]
+    return "\n".join(lines)
+
+
+def format_import_report(results: list) -> str:
+    lines = [f"{'module':20} {'import ms':>10} {'modules':>8}  created files"]
+    for result in results:
+        if 'error' in result:
+            lines.append(f"{result['module']:20} {result['error']}")
+            continue
+        lines.append(f"{result['module']:20} {result['median_ms']:10.2f} "
+                     f"{result['modules_loaded']:8d}  "
+                     f"{', '.join(result['created_files']) or '-'}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests of each request stage')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=50,
+                        help='run_spotify_app calls')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='rows of the database stages')
+    parser.add_argument('--limit', type=int, default=50,
+                        help='tracks per search page (1-50)')
+    parser.add_argument('--rate', type=float, default=10000.0,
+                        help='requests per second cap of the scheduler')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of a 500 response')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='probability of a 429 response')
+    parser.add_argument('--retry-after', type=float, default=0.05)
+    parser.add_argument('--markets', type=int, default=180,
+                        help='available_markets per search item')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--imports', action='store_true',
+                        help='measure the import cost of the DAG parse '
+                             'instead of the request pipeline')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+    if args.imports:
+        results = [import_time(module) for module in IMPORT_MODULES]
+        print(json.dumps(results, indent=2) if args.json
+              else format_import_report(results))
+        return
+    server = MockSpotifyServer(latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate,
+                               rate_limit_rate=args.rate_limit_rate,
+                               retry_after=args.retry_after,
+                               markets_per_item=args.markets, seed=args.seed)
+    benchmark = Benchmark(requests=args.requests,
+                          concurrency=args.concurrency, runs=args.runs,
+                          rows=args.rows, search_limit=args.limit)
+    report = run_benchmark(server, benchmark, args.rate)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,261 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import requests
+import threading
 import time
+import http_session
+import metrics
+import rate_limiter
 
+# faster json decoder if it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+LOG_PATH = "spotify_app.log"
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s : %(levelname)s : %(name)s : %(message)s")
 formatter.converter = time.gmtime
-file_handler = logging.FileHandler("spotify_app.log")
-file_handler.setFormatter(formatter)
-if logger.hasHandlers():
-    logger.handlers.clear()
-logger.addHandler(file_handler)
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line. Time is GMT 0 in ISO 8601 format."""
+
+    converter = time.gmtime
+
+    def format(self, record):
+        return json.dumps({
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") +
+                    f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+            }, ensure_ascii=False)
+
+
+log_config = {
+    "path": LOG_PATH,
+    "rotation": "external",      # 'external', 'size', 'time' or None
+    "max_bytes": 10 * 1024 ** 2,  # size rotation
+    "when": "midnight",          # time rotation, check TimedRotatingFileHandler
+    "backup_count": 5,
+    "json_format": False,
+    }
+
+_listener = None
+_logging_lock = threading.Lock()
+
+# functions called with the access token of a request that is refused
+# with 401, e.g. auth.TokenCache.discard_token (registered by auth.Tokens)
+rejected_token_handlers = []
+
+
+def configure_logging(**kwargs) -> None:
+    """
+    Log records are put into a queue by the request threads and coroutines
+    and written to the file by a QueueListener thread, so requests never
+    wait for disk writes.
+
+    >>> configure_logging(path="/var/log/spotify_app.log",
+    ...                   rotation="time", when="midnight", json_format=True)
+
+    Rotation :
+        'external' : the file is rotated by another tool (logrotate) and
+                     reopened after it is moved (WatchedFileHandler).
+                     Default; safe when several processes (the parallel
+                     playlist tasks, the harvester, ...) write the file.
+        'size'     : rotated at 'max_bytes' by the process
+        'time'     : rotated at 'when' by the process
+        None       : never rotated
+    'size' and 'time' are safe for one process per file only. Processes
+    that share the file rotate it independently and lose or misplace
+    records at rollover; give each process its own 'path' with them.
+
+    The handlers are set up on the first log record when this function is
+    not called.
+    """
+    global _listener
+    unknown = set(kwargs) - set(log_config)
+    if unknown:
+        raise TypeError(f"Unknown log config: {', '.join(sorted(unknown))}")
+    with _logging_lock:
+        log_config.update(kwargs)
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        if log_config["rotation"] == "external":
+            file_handler = logging.handlers.WatchedFileHandler(
+                log_config["path"], encoding="utf-8")
+        elif log_config["rotation"] == "size":
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_config["path"], maxBytes=log_config["max_bytes"],
+                backupCount=log_config["backup_count"], encoding="utf-8")
+        elif log_config["rotation"] == "time":
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                log_config["path"], when=log_config["when"],
+                backupCount=log_config["backup_count"], encoding="utf-8",
+                utc=True)
+        else:
+            file_handler = logging.FileHandler(log_config["path"],
+                                               encoding="utf-8")
+        file_handler.setFormatter(
+            JsonFormatter() if log_config["json_format"] else formatter)
+        log_queue = queue.SimpleQueue()
+        if logger.hasHandlers():
+            logger.handlers.clear()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, file_handler)
+        _listener.start()
+
+
+def ensure_logging() -> None:
+    """Sets up the handlers with the current config if they are not set up."""
+    if _listener is None:
+        configure_logging()
+
+
+def logging_configured() -> bool:
+    """True if the handlers are set up (check 'configure_logging')."""
+    return _listener is not None
+
+
+@atexit.register
+def stop_logging() -> None:
+    """
+    Writes the queued records and closes the file. The handlers are set up
+    again by the next 'configure_logging' or 'ensure_logging' call.
+    (Called before the interpreter exits.)
+    """
+    global _listener
+    with _logging_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
 
 
 def trigger_starttime_log():
     """Logging time is GMT 0"""
+    ensure_logging()
     time_format_name = formatter.converter.__name__
     logger.info("Spotify App executed. (time format: %s)", time_format_name)
 
 
+class CheckedResponse(object):
+    """
+    Wraps the requests.models.Response object that is returned by
+    'request_call_with_exception_check'.
+
+    The body is decoded once, on the first r.json() call, and the decoded
+    payload is reused by the following calls. Other attributes and methods
+    (status_code, headers, url, text, ...) are the ones of the response.
+    """
+
+    _not_decoded = object()
+
+    def __init__(self, response: requests.models.Response):
+        self.response = response
+        self._payload = self._not_decoded
+
+    def json(self):
+        if self._payload is self._not_decoded:
+            self._payload = json_loads(self.response.content)
+        return self._payload
+
+    def release(self) -> None:
+        """Drops the decoded payload. (r.json() decodes the body again)"""
+        self._payload = self._not_decoded
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __bool__(self):
+        return bool(self.response)
+
+    def __repr__(self):
+        return f"<CheckedResponse [{self.response.status_code}]>"
+
+
 class CustomRequestExceptionCheck(object):
+    """
+    Requests are sent through a shared requests.Session
+    (check http_session module). Connections are kept alive and reused by
+    the following requests of the process.
+
+        self.session   : requests.Session object
+        self.timeout   : (connect timeout, read timeout) in seconds
+        self.scheduler : rate_limiter.RequestScheduler object, shared by
+                         default. Caps requests per second, retries 429
+                         responses after Retry-After and 5xx responses
+                         with backoff.
+    """
+
+    def __init__(self, session=None, timeout=None, scheduler=None):
+        self._session = session
+        self._timeout = timeout
+        self._scheduler = scheduler
+
+    @property
+    def session(self):
+        if self._session is None:
+            return http_session.get_session()
+        return self._session
+
+    @property
+    def timeout(self):
+        if self._timeout is None:
+            return http_session.get_timeout()
+        return self._timeout
 
-    def request_call_with_exception_check(self, f):
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            return rate_limiter.get_scheduler()
+        return self._scheduler
+
+    def timed_call(self, f, request_from: str, idempotent: bool = True):
+        """
+        Sends the request through the scheduler and records its wall time,
+        size, status and retries. (check metrics module)
+        """
+        start = time.perf_counter()
+        try:
+            r = self.scheduler.call(f, idempotent=idempotent)
+        except requests.exceptions.RequestException as e:
+            metrics.request_metrics.observe(
+                request_from, time.perf_counter() - start, exception=e)
+            raise
+        metrics.request_metrics.observe(
+            request_from, time.perf_counter() - start, response=r)
+        return r
+
+    def reject_access_token(self, request) -> None:
+        """
+        Hands the bearer token of a request that is refused with 401 to the
+        'rejected_token_handlers'. Errors of the handlers are logged.
+        """
+        authorization = ""
+        if request is not None:
+            authorization = request.headers.get("Authorization") or ""
+        if not authorization.startswith("Bearer "):
+            return
+        access_token = authorization[len("Bearer "):]
+        for handler in list(rejected_token_handlers):
+            try:
+                handler(access_token)
+            except (OSError, ValueError) as e:
+                logger.error("%s, %s=%s", "token_invalidation=FAILED",
+                             "error", e)
+
+    def request_call_with_exception_check(self, f, idempotent: bool = True):
         """
         Request object.__bool__ returns:
                 True (success): if 200 <= status < 400
@@ -33,15 +266,26 @@ class CustomRequestExceptionCheck(object):
         Arguments:
             API request
                 r = request_call_with_exception_check(
-                lambda: requests.get(url, headers=headers),
+                lambda: self.session.get(url, headers=headers,
+                                         timeout=self.timeout),
                 )
+            idempotent (bool) : 5xx responses are retried by the scheduler
+                                only if True. False for requests that must
+                                not be applied twice (playlist add).
 
         Returns :
-            If no exception raise returns a "request object".
-            If exception catched returns "None".
+            If no exception raise returns a "CheckedResponse object"
+            (request object, its json body is decoded only once).
+            If the status is an error (4xx, 5xx) returns the
+            "CheckedResponse object" of the error response (bool(r) is
+            False), the caller can tell a refused request from a transient
+            failure by r.status_code.
+            If exception catched (no response) returns "None".
         """
+        ensure_logging()
         request_from = f.__qualname__.split(".")[:-2]
         request_from = ".".join(request_from)
+        caller_name = request_from
         request_from = "=".join(["request_from", request_from])
         # request_form format e.g.: "request_from:
         error_body = "".join(["request_status=FAILED",
@@ -49,14 +293,19 @@ class CustomRequestExceptionCheck(object):
                               "requests.exception="]
                             )
         try:
-            r = f()
+            r = self.timed_call(f, caller_name, idempotent)
             r.raise_for_status()
         except requests.exceptions.ConnectionError:
             logger.error("%s%s, %s", error_body, 'ConnectionError', request_from)
         except requests.exceptions.Timeout:
             logger.error("%s%s, %s", error_body, 'Timeout', request_from)
-        except requests.exceptions.HTTPError:
-            logger.error("%s%s, %s", error_body, 'HTTPError', request_from)
+        except requests.exceptions.HTTPError as e:
+            logger.error("%s%s, %s=%s, %s", error_body, 'HTTPError',
+                         "status_code", e.response.status_code, request_from)
+            # 401: Unauthorized - the access token is expired or revoked.
+            if e.response.status_code == 401:
+                self.reject_access_token(e.response.request)
+            return CheckedResponse(e.response)
         except requests.exceptions.ProxyError:
             logger.error("%s%s, %s", error_body, 'ProxyError', request_from)
         except requests.exceptions.SSLError:
@@ -64,22 +313,24 @@ class CustomRequestExceptionCheck(object):
         except requests.exceptions.RequestException as e:
             logger.error("%s%s, %s", error_body, e, request_from)
         else:
+            r = CheckedResponse(r)
             # Authentication Error Object Check
             try:
-                _ = r.json()['error']
-            except KeyError:
-                logger.info("%s, %s=%s, %s",
-                            "request_status=SUCCESS",
-                            "status_code", r.status_code,
-                            request_from,
-                            )
-                return r
-            else:
+                payload = r.json()
+            except ValueError:   # empty or non-json body
+                payload = None
+            if isinstance(payload, dict) and 'error' in payload:
                 logger.error("%s, %s=%s, %s=%s, %s",
                              "request_status=ERROR",
                              "status_code", r.status_code,
-                             "error", r.json(),
+                             "error", payload,
                              request_from
                              )
                 return r
+            logger.info("%s, %s=%s, %s",
+                        "request_status=SUCCESS",
+                        "status_code", r.status_code,
+                        request_from,
+                        )
+            return r
         return None
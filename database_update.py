@@ -1,39 +1,664 @@
+import random
 import sqlite3
 from datetime import datetime
+from itertools import islice
+from track_record import Track, NOT_AVAILABLE
 
 
-def update_db(track_details: dict, date_time: datetime) -> None:
-    conn = sqlite3.connect('track_request_history.sql')
-    cur = conn.cursor()
-
-    sql_db_create = """
-    CREATE TABLE IF NOT EXISTS Random_Tracks(
-            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-            date_time TEXT,
-            artist_name TEXT,
-            album_name TEXT,
-            track_name TEXT,
-            track_external_url TEXT,
-            track_uri TEXT
-    )
-    """
-    cur.execute(sql_db_create)
-
-    if track_details:
-        sql_update_db = """
-        INSERT INTO Random_Tracks
-        (date_time, artist_name, album_name, track_name, track_external_url, track_uri)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """
-        values = (
-            date_time,
-            track_details['artist_name'],
-            track_details['album_name'],
-            track_details['track_name'],
-            track_details['track_external_urls'],
-            track_details['track_uri']
-            )
-        cur.execute(sql_update_db, values)
-
-    conn.commit()
-    conn.close()
+DB_PATH = 'track_request_history.sql'
+
+sql_db_create = """
+CREATE TABLE IF NOT EXISTS Random_Tracks(
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        date_time TEXT,
+        artist_name TEXT,
+        album_name TEXT,
+        track_name TEXT,
+        track_external_url TEXT,
+        track_uri TEXT
+)
+"""
+
+# schema migrations, applied in order. PRAGMA user_version of the database
+# is the number of the applied migrations.
+MIGRATIONS = [
+    # 1: initial table
+    [sql_db_create],
+    # 2: remove duplicate tracks (the first add is kept), track_uri is unique,
+    #    indexes for "is this track added?" and date range lookups.
+    #    ! Data loss: the later adds of a track are deleted, only the first
+    #      row (and its date_time) is kept. Rows without a track uri
+    #      ('Not Available') are not tracks and are kept. Databases migrated
+    #      before this exclusion lost all but the first 'Not Available' row;
+    #      they cannot be restored from the database.
+    [
+        f"""
+        DELETE FROM Random_Tracks WHERE track_uri != '{NOT_AVAILABLE}'
+            AND id NOT IN
+            (SELECT MIN(id) FROM Random_Tracks GROUP BY track_uri)
+        """,
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_random_tracks_track_uri
+            ON Random_Tracks(track_uri) WHERE track_uri != '{NOT_AVAILABLE}'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_random_tracks_date_time
+            ON Random_Tracks(date_time)
+        """,
+    ],
+    # 3: local track corpus and the progress of the harvester queries
+    [
+        """
+        CREATE TABLE IF NOT EXISTS Track_Corpus(
+                id INTEGER NOT NULL PRIMARY KEY,
+                artist_name TEXT,
+                album_name TEXT,
+                track_name TEXT,
+                track_external_url TEXT,
+                track_uri TEXT NOT NULL UNIQUE,
+                search_word TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Harvest_Queries(
+                search_word TEXT NOT NULL PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                track_count INTEGER
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_harvest_queries_status
+            ON Harvest_Queries(status)
+        """,
+    ],
+    # 4: search outcomes of the query generator
+    [
+        """
+        CREATE TABLE IF NOT EXISTS Query_Stats(
+                search_word TEXT NOT NULL PRIMARY KEY,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                result_total INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ],
+    # 5: track metadata and audio features of the added tracks (enrichment
+    #    module). A row is written for each fetched track, available = 0 if
+    #    the API has no data for it, so no track is fetched twice.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS Track_Details(
+                track_uri TEXT NOT NULL PRIMARY KEY,
+                available INTEGER NOT NULL,
+                duration_ms INTEGER,
+                popularity INTEGER,
+                explicit INTEGER,
+                isrc TEXT,
+                disc_number INTEGER,
+                track_number INTEGER,
+                album_uri TEXT,
+                album_type TEXT,
+                release_date TEXT,
+                release_date_precision TEXT,
+                artist_uris TEXT,
+                fetched_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS Audio_Features(
+                track_uri TEXT NOT NULL PRIMARY KEY,
+                available INTEGER NOT NULL,
+                danceability REAL,
+                energy REAL,
+                key INTEGER,
+                loudness REAL,
+                mode INTEGER,
+                speechiness REAL,
+                acousticness REAL,
+                instrumentalness REAL,
+                liveness REAL,
+                valence REAL,
+                tempo REAL,
+                time_signature INTEGER,
+                fetched_at TEXT
+        )
+        """,
+    ],
+    # 6: 'Not Available' is not unique (unique index of migration 2 without
+    #    the exclusion is replaced)
+    [
+        "DROP INDEX IF EXISTS idx_random_tracks_track_uri",
+        f"""
+        CREATE UNIQUE INDEX idx_random_tracks_track_uri
+            ON Random_Tracks(track_uri) WHERE track_uri != '{NOT_AVAILABLE}'
+        """,
+    ],
+    # 7: playlist of the track (multi-playlist run mode), NULL for the rows
+    #    written before
+    ["ALTER TABLE Random_Tracks ADD COLUMN playlist_id TEXT"],
+    # 8: failed harvester queries are retried, 'failed' only after
+    #    CorpusWriter.max_attempts failed searches. The queries that failed
+    #    once before are pending again.
+    [
+        """
+        ALTER TABLE Harvest_Queries
+            ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+        """,
+        "UPDATE Harvest_Queries SET status = 'pending' WHERE status = 'failed'",
+    ],
+]
+
+DETAIL_COLUMNS = ('duration_ms', 'popularity', 'explicit', 'isrc',
+                  'disc_number', 'track_number', 'album_uri', 'album_type',
+                  'release_date', 'release_date_precision', 'artist_uris')
+AUDIO_FEATURE_COLUMNS = ('danceability', 'energy', 'key', 'loudness', 'mode',
+                         'speechiness', 'acousticness', 'instrumentalness',
+                         'liveness', 'valence', 'tempo', 'time_signature')
+# side tables of the enrichment: columns of the API object
+ENRICHMENT_TABLES = {'Track_Details': DETAIL_COLUMNS,
+                     'Audio_Features': AUDIO_FEATURE_COLUMNS}
+
+# conflict target of the partial unique index (migration 2 and 6)
+_track_uri_conflict = f"ON CONFLICT(track_uri) WHERE track_uri != '{NOT_AVAILABLE}'"
+
+sql_update_db = f"""
+INSERT INTO Random_Tracks
+(date_time, artist_name, album_name, track_name, track_external_url, track_uri,
+ playlist_id)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+{_track_uri_conflict} DO UPDATE SET
+    date_time = excluded.date_time,
+    artist_name = excluded.artist_name,
+    album_name = excluded.album_name,
+    track_name = excluded.track_name,
+    track_external_url = excluded.track_external_url,
+    playlist_id = excluded.playlist_id
+"""
+
+sql_insert_corpus = """
+INSERT INTO Track_Corpus
+(artist_name, album_name, track_name, track_external_url, track_uri, search_word)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(track_uri) DO NOTHING
+"""
+
+sql_insert_ignore_db = f"""
+INSERT INTO Random_Tracks
+(date_time, artist_name, album_name, track_name, track_external_url, track_uri,
+ playlist_id)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+{_track_uri_conflict} DO NOTHING
+"""
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Applies the migrations that are not applied to the database yet, in
+    one transaction.
+
+    The write lock is taken (BEGIN IMMEDIATE) before user_version is read
+    again, so processes that open the database at the same time (e.g. the
+    parallel playlist tasks) wait for each other and apply a migration
+    only once.
+
+    Returns  :
+        version (int) : schema version of the database
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(MIGRATIONS[version:],
+                                             version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            # PRAGMA does not accept parameters
+            conn.execute(f"PRAGMA user_version = {version:d}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return version
+
+
+def track_row(track_details, date_time: datetime,
+              playlist_id: str = None) -> tuple:
+    """
+    Argument :
+        track_details : 'extract_track_info' dict or track_record.Track
+        playlist_id   : playlist the track is added to
+
+    Returns  :
+        values (tuple) : Random_Tracks row in 'sql_update_db' order
+    """
+    if isinstance(track_details, Track):
+        return (date_time, *track_details, playlist_id)
+    return (
+        date_time,
+        track_details['artist_name'],
+        track_details['album_name'],
+        track_details['track_name'],
+        track_details['track_external_urls'],
+        track_details['track_uri'],
+        playlist_id
+        )
+
+
+def corpus_row(track: Track, search_word: str) -> tuple:
+    """Returns the values of a Track_Corpus row in 'sql_insert_corpus' order."""
+    return (*track, search_word)
+
+
+class Database(object):
+    """
+    One connection to the database, shared by the writers of this module.
+
+    The database is switched to WAL journal mode and the migrations are
+    applied. Rows are inserted with executemany and committed once per
+    batch instead of once per row.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL is durable against application crashes and
+        # syncs only on checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        migrate(self.conn)
+
+    def write_batches(self, sql: str, rows, batch_size: int) -> int:
+        """
+        Argument :
+            rows (iterable) : parameter tuples of 'sql'. Can be a generator,
+                              it is consumed 'batch_size' rows at a time.
+
+        Returns  :
+            count (int) : number of the executed rows
+        """
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return count
+            self.conn.executemany(sql, batch)
+            self.conn.commit()
+            count += len(batch)
+
+    def finish(self, commit: bool = True) -> None:
+        """Commits (or rolls back) the open transaction and closes."""
+        if commit:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class TrackWriter(object):
+    """
+    Keeps one connection to the database open and writes Random_Tracks rows
+    in batches.
+
+        with TrackWriter() as writer:
+            writer.write_many((track_details, dt) for track_details in tracks)
+
+    Rows are committed once per 'batch_size' rows (check Database).
+
+    track_uri is unique. If a track is written again:
+        on_conflict='ignore' : the existing row is kept (default). The
+                               history keeps the first add time and the
+                               rowid order is the add order, which the
+                               rowid incremental readers (seen_tracks,
+                               history_export) rely on.
+        on_conflict='update' : the row is updated with the new values,
+                               including date_time, in place
+    """
+
+    def __init__(self, db_path: str = DB_PATH, batch_size: int = 500,
+                 on_conflict: str = 'ignore'):
+        if on_conflict not in ('update', 'ignore'):
+            raise ValueError("on_conflict must be 'update' or 'ignore'")
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.sql_insert = (sql_update_db if on_conflict == 'update'
+                           else sql_insert_ignore_db)
+        self.db = Database(db_path)
+        self.conn = self.db.conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.finish(commit=exc_type is None)
+
+    def write(self, track_details: dict, date_time: datetime,
+              playlist_id: str = None) -> None:
+        """Inserts and commits one row."""
+        if track_details:
+            self.conn.execute(self.sql_insert,
+                              track_row(track_details, date_time, playlist_id))
+        self.conn.commit()
+
+    def write_many(self, rows) -> int:
+        """
+        Argument :
+            rows (iterable) : (track_details, date_time) pairs or
+                              (track_details, date_time, playlist_id).
+                              track_details is a dict or a Track.
+                              Can be a generator, it is consumed
+                              'batch_size' rows at a time.
+
+        Returns  :
+            count (int) : number of inserted rows
+        """
+        return self.db.write_batches(
+                    self.sql_insert,
+                    (track_row(*row) for row in rows if row[0]),
+                    self.batch_size)
+
+    def has_track(self, track_uri: str) -> bool:
+        """Index lookup, does not scan the table."""
+        cur = self.conn.execute(
+            "SELECT 1 FROM Random_Tracks WHERE track_uri = ?", (track_uri,))
+        return cur.fetchone() is not None
+
+    def tracks_between(self, start: datetime, end: datetime) -> list:
+        """
+        Returns  :
+            rows (list) : Random_Tracks rows added in [start, end)
+        """
+        cur = self.conn.execute(
+            "SELECT * FROM Random_Tracks WHERE date_time >= ? AND date_time < ?"
+            " ORDER BY date_time",
+            (str(start), str(end)))
+        return cur.fetchall()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class CorpusWriter(object):
+    """
+    Bulk writer of the local track corpus (Track_Corpus table) and of the
+    harvester query progress (Harvest_Queries table).
+
+        with CorpusWriter() as writer:
+            writer.write_many((track, search_word) for track in tracks)
+
+    A track that is already in the corpus is skipped.
+
+    Argument :
+        max_attempts (int) : failed searches after which a query is
+                             'failed' and not searched again. Failed
+                             searches (token error, 429, 5xx, ...) stay
+                             'pending' until then.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, batch_size: int = 5000,
+                 max_attempts: int = 3):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.db = Database(db_path)
+        self.conn = self.db.conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.finish(commit=exc_type is None)
+
+    def write_many(self, rows) -> int:
+        """
+        Argument :
+            rows (iterable) : (track, search_word) pairs
+
+        Returns  :
+            count (int) : number of the rows
+        """
+        return self.db.write_batches(
+                    sql_insert_corpus,
+                    (corpus_row(*row) for row in rows if row[0]),
+                    self.batch_size)
+
+    def add_queries(self, search_words) -> None:
+        """Adds the search words as 'pending' (known ones are skipped)."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO Harvest_Queries (search_word)"
+                " VALUES (?)",
+                ((search_word,) for search_word in search_words))
+
+    def pending_queries(self) -> list:
+        cur = self.conn.execute(
+            "SELECT search_word FROM Harvest_Queries WHERE status = 'pending'")
+        return [search_word for (search_word,) in cur]
+
+    def write_query_results(self, results) -> int:
+        """
+        Writes the tracks of the finished queries and marks the queries in
+        the same transaction, so an interrupted harvest resumes from the
+        queries that are not written. A failed query stays 'pending' for
+        the next harvest until it fails 'max_attempts' times.
+
+        Argument :
+            results (iterable) : (search_word, tracks) pairs.
+                                 tracks is None if the search failed.
+
+        Returns  :
+            count (int) : number of the tracks in the results
+        """
+        count = 0
+        with self.conn:
+            for search_word, tracks in results:
+                if tracks is None:
+                    self.conn.execute(
+                        "UPDATE Harvest_Queries SET attempts = attempts + 1,"
+                        " status = CASE WHEN attempts + 1 >= ?"
+                        " THEN 'failed' ELSE 'pending' END"
+                        " WHERE search_word = ?",
+                        (self.max_attempts, search_word))
+                    continue
+                self.conn.executemany(
+                    sql_insert_corpus,
+                    (corpus_row(track, search_word) for track in tracks))
+                count += len(tracks)
+                self.conn.execute(
+                    "UPDATE Harvest_Queries SET status = 'done',"
+                    " track_count = ? WHERE search_word = ?",
+                    (len(tracks), search_word))
+        return count
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def details_row(track_uri: str, item: dict, fetched_at: datetime) -> tuple:
+    """
+    Argument :
+        item (dict) : full track object of /v1/tracks, None if not found
+
+    Returns  :
+        values (tuple) : Track_Details row in 'sql_insert_enrichment' order
+    """
+    if item is None:
+        return (track_uri, 0, *(None,) * len(DETAIL_COLUMNS), str(fetched_at))
+    album = item.get('album') or {}
+    explicit = item.get('explicit')
+    return (
+        track_uri,
+        1,
+        item.get('duration_ms'),
+        item.get('popularity'),
+        None if explicit is None else int(explicit),
+        (item.get('external_ids') or {}).get('isrc'),
+        item.get('disc_number'),
+        item.get('track_number'),
+        album.get('uri'),
+        album.get('album_type'),
+        album.get('release_date'),
+        album.get('release_date_precision'),
+        ','.join(artist['uri'] for artist in item.get('artists') or ()
+                 if artist.get('uri')),
+        str(fetched_at)
+        )
+
+
+def audio_features_row(track_uri: str, features: dict,
+                       fetched_at: datetime) -> tuple:
+    """
+    Argument :
+        features (dict) : audio features object, None if there is none
+
+    Returns  :
+        values (tuple) : Audio_Features row in 'sql_insert_enrichment' order
+    """
+    features = features or {}
+    return (track_uri, int(bool(features)),
+            *(features.get(column) for column in AUDIO_FEATURE_COLUMNS),
+            str(fetched_at))
+
+
+def sql_insert_enrichment(table: str) -> str:
+    columns = ('track_uri', 'available', *ENRICHMENT_TABLES[table],
+               'fetched_at')
+    return (f"INSERT INTO {table} ({', '.join(columns)})"
+            f" VALUES ({', '.join('?' * len(columns))})"
+            " ON CONFLICT(track_uri) DO NOTHING")
+
+
+class EnrichmentWriter(object):
+    """
+    Bulk writer of the Track_Details and Audio_Features side tables.
+
+        with EnrichmentWriter() as writer:
+            track_uris = writer.missing('Track_Details')
+            ...
+            writer.write_rows('Track_Details', rows)
+
+    The side tables are the cache of the enrichment: 'missing' returns only
+    the Random_Tracks uris that have no row in the table yet.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, batch_size: int = 1000):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.db = Database(db_path)
+        self.conn = self.db.conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.finish(commit=exc_type is None)
+
+    def missing(self, table: str, limit: int = None) -> list:
+        """
+        Returns  :
+            track_uris (list) : uris of the Random_Tracks rows that are not
+                                in 'table', in the order they are added
+        """
+        if table not in ENRICHMENT_TABLES:
+            raise ValueError(f"table must be one of {tuple(ENRICHMENT_TABLES)}")
+        cur = self.conn.execute(
+            f"SELECT track_uri FROM Random_Tracks AS r"
+            " WHERE track_uri LIKE 'spotify:track:%' AND NOT EXISTS"
+            f" (SELECT 1 FROM {table} AS e WHERE e.track_uri = r.track_uri)"
+            " ORDER BY id LIMIT ?",
+            (-1 if limit is None else limit,))
+        return [track_uri for (track_uri,) in cur]
+
+    def write_rows(self, table: str, rows) -> int:
+        """
+        Argument :
+            rows (iterable) : 'details_row' or 'audio_features_row' tuples,
+                              committed 'batch_size' rows at a time
+
+        Returns  :
+            count (int) : number of the written rows
+        """
+        return self.db.write_batches(sql_insert_enrichment(table), rows,
+                                     self.batch_size)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+_corpus_columns = ("artist_name, album_name, track_name, track_external_url,"
+                   " track_uri, search_word")
+
+
+def sample_corpus_track(seen=(), db_path: str = DB_PATH, attempts: int = 64,
+                        excluded=()):
+    """
+    Picks a uniformly random track of the Track_Corpus table that is not in
+    'seen', without ORDER BY RANDOM() (which reads the whole table).
+
+    A random id between MIN(id) and MAX(id) is looked up by the primary key
+    (O(log n)). Missing ids (gaps) and seen tracks are rejected and another
+    id is drawn, so every unseen track has the same probability.
+
+    If all 'attempts' draws are rejected (most of the corpus is seen), the
+    corpus is scanned by id from a random id, wrapping around, for a track
+    that is not in Random_Tracks, 'seen' or 'excluded'. That track is not
+    uniformly random but is found whenever one is left.
+
+    The database is opened read-only and is not migrated.
+
+    Argument :
+        seen (container) : track uris to skip, e.g. seen_tracks.SeenTracks
+        attempts (int)   : number of the ids to draw
+        excluded (container) : other track uris to skip, e.g.
+                               outbox.Outbox.blocked_uris
+
+    Returns  :
+        (track, search_word) : track_record.Track and its search word
+        None                 : if there is no corpus or no unseen track
+    """
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return None
+    try:
+        min_id, max_id = conn.execute(
+            "SELECT MIN(id), MAX(id) FROM Track_Corpus").fetchone()
+        if min_id is None:
+            return None
+        for i in range(attempts):
+            row = conn.execute(
+                f"SELECT {_corpus_columns} FROM Track_Corpus WHERE id = ?",
+                (random.randint(min_id, max_id),)).fetchone()
+            if row is not None and row[4] != NOT_AVAILABLE \
+                    and row[4] not in seen and row[4] not in excluded:
+                return Track(*row[:5]), row[5]
+
+        start_id = random.randint(min_id, max_id)
+        for id_range in ("id >= ?", "id < ?"):
+            cur = conn.execute(
+                f"SELECT {_corpus_columns} FROM Track_Corpus AS c"
+                f" WHERE {id_range} AND track_uri != ? AND NOT EXISTS"
+                " (SELECT 1 FROM Random_Tracks AS r"
+                "  WHERE r.track_uri = c.track_uri AND r.track_uri != ?)"
+                " ORDER BY id",
+                (start_id, NOT_AVAILABLE, NOT_AVAILABLE))
+            for row in cur:
+                if row[4] not in seen and row[4] not in excluded:
+                    return Track(*row[:5]), row[5]
+        return None
+    except sqlite3.OperationalError:
+        # tables that are not created yet
+        return None
+    finally:
+        conn.close()
+
+
+def update_db(track_details: dict, date_time: datetime,
+              playlist_id: str = None) -> None:
+    with TrackWriter() as writer:
+        writer.write(track_details, date_time, playlist_id)
@@ -0,0 +1,159 @@
+"""
+Track metadata enrichment of the added tracks.
+
+The uris of the Random_Tracks rows that are not enriched yet are fetched
+from the multi-id endpoints of the API, 50 tracks per /v1/tracks request
+and 100 per /v1/audio-features request, and written to the Track_Details
+and Audio_Features tables of track_request_history.sql by one
+EnrichmentWriter. Enriching 10k tracks takes about 300 requests instead of
+one request per track.
+
+    python enrichment.py --concurrency 4
+
+A track that has a row in a side table is not fetched again (the tables
+are the cache); tracks the API has no data for get a row with available=0.
+"""
+import argparse
+import threading
+from datetime import datetime, timezone
+import auth
+import api_task_requests
+import database_update
+import http_session
+from custom_exception_check import trigger_starttime_log
+from pipeline import Pipeline, Stage, StopPipeline
+
+
+# side table: (Spochastify method, response key, ids per request, row function)
+ENDPOINTS = {
+    'Track_Details': ('get_several_tracks', 'tracks',
+                      api_task_requests.TRACKS_LIMIT,
+                      database_update.details_row),
+    'Audio_Features': ('get_several_audio_features', 'audio_features',
+                       api_task_requests.AUDIO_FEATURES_LIMIT,
+                       database_update.audio_features_row),
+    }
+
+
+class Enricher(object):
+    """
+    Argument :
+        concurrency (int) : requests in flight
+        tables (tuple)    : side tables to fill, keys of ENDPOINTS
+
+    Each table is filled by a pipeline:
+        missing uris -> fetch (batches of the API limit, 'concurrency'
+                        wide) -> write (one commit per response)
+    A failed request stops the pipeline of that table; the uris that are
+    not written are fetched by the next run.
+    """
+
+    def __init__(self, concurrency: int = 4,
+                 tables: tuple = tuple(ENDPOINTS),
+                 db_path: str = database_update.DB_PATH):
+        self.concurrency = concurrency
+        self.tables = tables
+        self.db_path = db_path
+        if http_session.session_config["pool_maxsize"] < concurrency:
+            http_session.configure_session(pool_maxsize=concurrency)
+        self.token = auth.Tokens()
+        self.spochastify = api_task_requests.Spochastify()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def fetch_stage(self, table: str) -> Stage:
+        """
+        [track_uri, ...] -> [row, ...] of 'table', one output per request
+        """
+        method_name, key, id_limit, make_row = ENDPOINTS[table]
+        request = getattr(self.spochastify, method_name)
+
+        def fetch(track_uris):
+            client_credential_access_token, r = \
+                self.token.get_cached_client_credential_access_token()
+            if client_credential_access_token is None:
+                raise StopPipeline(r)
+            r = request(client_credential_access_token,
+                        [api_task_requests.track_id(track_uri)
+                         for track_uri in track_uris])
+            with self._lock:
+                self.requests += 1
+            # 200: OK - The request has succeeded.
+            if r is None or r.status_code != 200:
+                raise StopPipeline(r)
+            fetched_at = datetime.now(timezone.utc)
+            # objects are in request order, None for unknown ids
+            return [[make_row(track_uri, item, fetched_at)
+                     for track_uri, item in zip(track_uris, r.json()[key])]]
+        return Stage(f'fetch_{table}', fetch, concurrency=self.concurrency,
+                     batch_size=id_limit)
+
+    def enrich(self, writer: database_update.EnrichmentWriter, table: str,
+               limit: int = None) -> tuple:
+        """
+        Returns  :
+            (count, stop) : number of the written rows,
+                            StopPipeline of the failed request or None
+        """
+        def write(rows):
+            return [writer.write_rows(table, rows)]
+
+        count = 0
+        try:
+            for written in Pipeline(self.fetch_stage(table),
+                                    Stage('write', write)).stream(
+                                        writer.missing(table, limit)):
+                count += written
+        except StopPipeline as stop:
+            return count, stop
+        return count, None
+
+    def run(self, limit: int = None) -> dict:
+        """
+        Argument :
+            limit (int) : maximum number of the tracks per table
+
+        Returns  :
+            summary (dict) :
+                {
+                    'Track_Details': 120,       # written rows
+                    'Audio_Features': 120,
+                    'requests': 5,
+                    'failed': {}                # table: status code of the
+                }                               # failed request (None if
+                                                # exception catched)
+        """
+        trigger_starttime_log()
+        summary = {}
+        failed = {}
+        with database_update.EnrichmentWriter(self.db_path) as writer:
+            for table in self.tables:
+                summary[table], stop = self.enrich(writer, table, limit)
+                if stop is not None:
+                    failed[table] = getattr(stop.value, 'status_code', None)
+        summary['requests'] = self.requests
+        summary['failed'] = failed
+        return summary
+
+
+def enrich_tracks(concurrency: int = 4, limit: int = None) -> dict:
+    """Airflow task callable, returns 'Enricher.run' summary."""
+    return Enricher(concurrency=concurrency).run(limit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=None,
+                        help='maximum number of the tracks per table')
+    parser.add_argument('--tables', nargs='+', choices=tuple(ENDPOINTS),
+                        default=list(ENDPOINTS))
+    parser.add_argument('--db', default=database_update.DB_PATH)
+    args = parser.parse_args()
+    enricher = Enricher(concurrency=args.concurrency,
+                        tables=tuple(args.tables), db_path=args.db)
+    print(enricher.run(args.limit))
+
+
+if __name__ == '__main__':
+    main()
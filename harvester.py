@@ -0,0 +1,165 @@
+"""
+Bulk harvester of the local track corpus.
+
+Generates many random search words up front, stores them in the
+Harvest_Queries table and spreads the searches over a pool of workers.
+The projected tracks are streamed into the Track_Corpus table of
+track_request_history.sql by one CorpusWriter.
+
+    python harvester.py --queries 10000 --concurrency 8
+
+An interrupted harvest resumes from the pending queries of the
+Harvest_Queries table when it is started again. A failed search (token
+error, 429, 5xx, ...) leaves its query pending for the next harvest, up to
+CorpusWriter.max_attempts searches.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import auth
+import api_task_requests
+import database_update
+import http_session
+from custom_exception_check import trigger_starttime_log
+import query_generator
+
+
+def generate_search_words(query_count: int, known=(),
+                          next_query=query_generator.random_string) -> list:
+    """Returns 'query_count' distinct random search words that are not known."""
+    known = set(known)
+    search_words = set()
+    # the number of distinct random words is limited, stop if they run out
+    for i in range(query_count * 20):
+        if len(search_words) >= query_count:
+            break
+        search_word = next_query()
+        if search_word not in known:
+            search_words.add(search_word)
+    return list(search_words)
+
+
+class Harvester(object):
+    """
+    Argument :
+        concurrency (int)    : number of the searches in flight
+        search_limit (int)   : tracks per result page (1-50)
+        pages_per_query (int): result pages requested for each search word
+        write_every (int)    : finished queries per database transaction
+
+    The workers are threads of one process. They share the session
+    connection pools, the rate limiting scheduler and the token cache.
+    Searches are I/O bound, so threads are enough and the token bucket
+    stays one bucket for all of the workers.
+    """
+
+    def __init__(self, concurrency: int = 8, search_limit: int = 50,
+                 pages_per_query: int = 1, write_every: int = 50,
+                 db_path: str = database_update.DB_PATH):
+        self.concurrency = concurrency
+        self.search_limit = search_limit
+        self.pages_per_query = pages_per_query
+        self.write_every = write_every
+        self.db_path = db_path
+        if http_session.session_config["pool_maxsize"] < concurrency:
+            http_session.configure_session(pool_maxsize=concurrency)
+        self.token = auth.Tokens()
+        self.spochastify = api_task_requests.Spochastify()
+
+    def search(self, search_word: str) -> tuple:
+        """
+        Worker. Requests the result pages of a search word.
+
+        Returns  :
+            (search_word, tracks) : tracks is None if a request is failed
+        """
+        client_credential_access_token, r = \
+            self.token.get_cached_client_credential_access_token()
+        if client_credential_access_token is None:
+            return search_word, None
+        tracks = []
+        for r_search in self.spochastify.iter_search_pages(
+                            client_credential_access_token,
+                            search_word,
+                            limit=self.search_limit,
+                            max_pages=self.pages_per_query):
+            if r_search is None or r_search.status_code != 200:
+                return search_word, None
+            tracks.extend(self.spochastify.get_tracks(r_search))
+        return search_word, tracks
+
+    def run(self, query_count: int = 1000) -> dict:
+        """
+        Harvests the pending queries. If there is no pending query,
+        'query_count' new search words are generated first.
+
+        Returns  :
+            summary (dict) : {'queries': int, 'failed': int, 'tracks': int}
+        """
+        trigger_starttime_log()
+        summary = {'queries': 0, 'failed': 0, 'tracks': 0}
+        queries = query_generator.QueryGenerator(self.db_path)
+        with database_update.CorpusWriter(self.db_path) as writer:
+            search_words = writer.pending_queries()
+            if not search_words:
+                known = (row[0] for row in writer.conn.execute(
+                            "SELECT search_word FROM Harvest_Queries"))
+                writer.add_queries(generate_search_words(query_count, known,
+                                                         queries.next_query))
+                search_words = writer.pending_queries()
+
+            finished = []
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                search_words = iter(search_words)
+                in_flight = set()
+                while True:
+                    # keep at most 2 * concurrency searches submitted,
+                    # results are written as they arrive
+                    for search_word in search_words:
+                        in_flight.add(executor.submit(self.search, search_word))
+                        if len(in_flight) >= 2 * self.concurrency:
+                            break
+                    if not in_flight:
+                        break
+                    done, in_flight = wait(in_flight,
+                                           return_when=FIRST_COMPLETED)
+                    for future in done:
+                        search_word, tracks = future.result()
+                        finished.append((search_word, tracks))
+                        summary['queries'] += 1
+                        summary['failed'] += tracks is None
+                    if len(finished) >= self.write_every:
+                        summary['tracks'] += self.write(writer, queries,
+                                                        finished)
+                        finished = []
+            summary['tracks'] += self.write(writer, queries, finished)
+        queries.close()
+        return summary
+
+    def write(self, writer, queries, finished: list) -> int:
+        """Writes the tracks and the search outcomes of the finished queries."""
+        queries.record_many((search_word, len(tracks))
+                            for search_word, tracks in finished
+                            if tracks is not None)
+        return writer.write_query_results(finished)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='number of new search words if none is pending')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=50,
+                        help='tracks per result page (1-50)')
+    parser.add_argument('--pages', type=int, default=1,
+                        help='result pages per search word')
+    parser.add_argument('--db', default=database_update.DB_PATH)
+    args = parser.parse_args()
+    harvester = Harvester(concurrency=args.concurrency,
+                          search_limit=args.limit,
+                          pages_per_query=args.pages,
+                          db_path=args.db)
+    print(harvester.run(args.queries))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Incremental columnar export of the Random_Tracks history.
+
+The rows added since the last export (rowid greater than the exported one)
+are read from track_request_history.sql in chunks, through a read-only
+connection (the live database is not locked), and written as Parquet or
+Arrow IPC files partitioned by the add date:
+
+    track_history/date=2021-12-12/part-0000000001.parquet
+    track_history/_export_state.json      (last exported rowid)
+
+    python history_export.py
+    python history_export.py --out /data/track_history --format arrow
+
+    dataset = read_history('track_history')
+    dataset.to_table(filter=pyarrow.dataset.field('date') >= '2021-12-01')
+
+date_time is stored as timestamp[us, UTC] (it is TEXT in SQLite),
+artist_name, album_name and playlist_id are dictionary encoded. Arrow IPC
+files are uncompressed so that they can be memory-mapped.
+
+Requires pyarrow (pip install pyarrow).
+"""
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+import database_update
+
+# optional dependency, only this module needs it
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+EXPORT_DIR = 'track_history'
+STATE_FILE = '_export_state.json'
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+# hive partition name of the rows without a parsable date_time
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+_columns = ('id', 'date_time', 'artist_name', 'album_name', 'track_name',
+            'track_external_url', 'track_uri', 'playlist_id')
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError(
+            "history_export requires pyarrow: pip install pyarrow")
+
+
+def export_schema():
+    require_pyarrow()
+    dictionary_string = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('date_time', pa.timestamp('us', tz='UTC')),
+        ('artist_name', dictionary_string),
+        ('album_name', dictionary_string),
+        ('track_name', pa.string()),
+        ('track_external_url', pa.string()),
+        ('track_uri', pa.string()),
+        ('playlist_id', dictionary_string),
+        ])
+
+
+def parse_date_time(value: str):
+    """
+    >>> parse_date_time('2021-12-12 13:07:19.254635+00:00')
+    datetime.datetime(2021, 12, 12, 13, 7, 19, 254635, tzinfo=datetime.timezone.utc)
+
+    Values without a time zone are UTC. Returns None if it is not parsable.
+    """
+    try:
+        date_time = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if date_time.tzinfo is None:
+        return date_time.replace(tzinfo=timezone.utc)
+    return date_time.astimezone(timezone.utc)
+
+
+class HistoryExporter(object):
+    """
+    Argument :
+        db_path (str)     : track_request_history.sql
+        out_dir (str)     : root directory of the partitioned files
+        file_format (str) : 'parquet' or 'arrow' (Arrow IPC / Feather v2)
+        chunk_size (int)  : rows read and written at a time, memory is
+                            bounded by one chunk
+        compression (str) : parquet compression ('snappy', 'zstd', ...)
+
+    Every chunk is written as one file per date partition, named after the
+    first rowid of the file. The state file is updated after each chunk; an
+    interrupted export continues from the last finished chunk (a rewritten
+    chunk replaces its files).
+    """
+
+    def __init__(self, db_path: str = database_update.DB_PATH,
+                 out_dir: str = EXPORT_DIR, file_format: str = 'parquet',
+                 chunk_size: int = 50000, compression: str = 'snappy'):
+        require_pyarrow()
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError("file_format must be 'parquet' or 'arrow'")
+        self.db_path = db_path
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.schema = export_schema()
+        self.state_path = os.path.join(out_dir, STATE_FILE)
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'last_rowid': 0}
+
+    def save_state(self, state: dict) -> None:
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def iter_chunks(self, last_rowid: int):
+        """
+        Generator. Yields lists of the Random_Tracks rows after
+        'last_rowid', in rowid order. Rows added while the export runs are
+        left to the next export.
+        """
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        try:
+            max_rowid = conn.execute(
+                "SELECT MAX(id) FROM Random_Tracks").fetchone()[0] or 0
+            # playlist_id is added by a migration, NULL if it is not applied
+            table_columns = {row[1] for row in conn.execute(
+                                "PRAGMA table_info(Random_Tracks)")}
+            columns = [column if column in table_columns
+                       else f"NULL AS {column}" for column in _columns]
+            cur = conn.execute(
+                f"SELECT {', '.join(columns)} FROM Random_Tracks"
+                " WHERE id > ? AND id <= ? ORDER BY id",
+                (last_rowid, max_rowid))
+            while True:
+                rows = cur.fetchmany(self.chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.close()
+
+    def to_table(self, rows: list):
+        """Returns a pyarrow.Table of the rows in 'export_schema'."""
+        columns = list(zip(*rows))
+        arrays = []
+        for name, values in zip(_columns, columns):
+            field_type = self.schema.field(name).type
+            if name == 'date_time':
+                values = [parse_date_time(value) for value in values]
+            if pa.types.is_dictionary(field_type):
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, field_type))
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write_table(self, table, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if self.file_format == 'parquet':
+            pq.write_table(table, tmp_path, compression=self.compression,
+                           use_dictionary=['artist_name', 'album_name',
+                                           'playlist_id'])
+        else:
+            feather.write_feather(table, tmp_path,
+                                  compression='uncompressed')
+        os.replace(tmp_path, path)
+
+    def write_chunk(self, rows: list) -> list:
+        """
+        Writes the rows into their date partitions.
+
+        Returns  :
+            paths (list) : written files
+        """
+        partitions = {}          # partition name: [row, ...]
+        for row in rows:
+            date_time = parse_date_time(row[1])
+            partition = date_time.date().isoformat() if date_time \
+                else NULL_PARTITION
+            partitions.setdefault(partition, []).append(row)
+        paths = []
+        extension = FILE_EXTENSIONS[self.file_format]
+        for partition, partition_rows in partitions.items():
+            directory = os.path.join(self.out_dir, f"date={partition}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory, f"part-{partition_rows[0][0]:010d}.{extension}")
+            self.write_table(self.to_table(partition_rows), path)
+            paths.append(path)
+        return paths
+
+    def run(self) -> dict:
+        """
+        Exports the rows added since the last run.
+
+        Returns  :
+            summary (dict) : {'rows': int, 'files': int, 'last_rowid': int}
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+        state = self.load_state()
+        summary = {'rows': 0, 'files': 0, 'last_rowid': state['last_rowid']}
+        for rows in self.iter_chunks(state['last_rowid']):
+            summary['files'] += len(self.write_chunk(rows))
+            summary['rows'] += len(rows)
+            state['last_rowid'] = summary['last_rowid'] = rows[-1][0]
+            self.save_state(state)
+        return summary
+
+
+def read_history(out_dir: str = EXPORT_DIR, file_format: str = 'parquet'):
+    """
+    Returns  :
+        dataset : pyarrow.dataset.Dataset of the exported files, with the
+                  'date' partition column
+    """
+    require_pyarrow()
+    return ds.dataset(out_dir,
+                      format='ipc' if file_format == 'arrow' else 'parquet',
+                      partitioning='hive', exclude_invalid_files=False,
+                      ignore_prefixes=['_', '.'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', default=database_update.DB_PATH)
+    parser.add_argument('--out', default=EXPORT_DIR)
+    parser.add_argument('--format', choices=tuple(FILE_EXTENSIONS),
+                        default='parquet')
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--compression', default='snappy',
+                        help='parquet compression codec')
+    args = parser.parse_args()
+    exporter = HistoryExporter(db_path=args.db, out_dir=args.out,
+                               file_format=args.format,
+                               chunk_size=args.chunk_size,
+                               compression=args.compression)
+    print(exporter.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# (connect timeout, read timeout) in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+
+session_config = {
+    "pool_connections": 4,    # number of hosts to keep pools for
+    "pool_maxsize": 10,       # connections kept alive per host
+    "max_retries": 3,         # connection retries of the HTTP adapter
+    "backoff_factor": 0.3,    # sleep between retries: factor * 2**(n-1)
+    "timeout": DEFAULT_TIMEOUT,
+    }
+
+# base urls of the endpoints, can be pointed to a local stand-in server
+# (check mock_spotify_server module)
+base_urls = {
+    "accounts": "https://accounts.spotify.com",
+    "api": "https://api.spotify.com",
+    }
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def build_session(pool_connections=4, pool_maxsize=10,
+                  max_retries=3, backoff_factor=0.3, **kwargs) -> requests.Session:
+    """
+    Argument :
+        pool_connections (int)  : number of host connection pools to cache
+        pool_maxsize     (int)  : maximum number of connections kept alive
+                                  per host
+        max_retries      (int)  : retries on connection errors. Read
+                                  errors are retried only for GET requests;
+                                  a POST (e.g. playlist add) may already be
+                                  applied by the server and is not sent
+                                  again. (429 and 5xx responses are retried
+                                  by rate_limiter.RequestScheduler)
+        backoff_factor (float)  : sleep between the retries
+
+    Returns  :
+        session : requests.Session object
+                  Connections to accounts.spotify.com and api.spotify.com
+                  are kept alive and reused by the following requests.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status=0,
+        respect_retry_after_header=False,
+        # connect errors are retried for every method (nothing was sent),
+        # read errors only for GET. Playlist add POSTs are not idempotent.
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+        )
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def configure_session(**kwargs) -> None:
+    """
+    Updates the session config. The shared session is rebuilt with the new
+    config on the next 'get_session' call.
+
+    >>> configure_session(pool_maxsize=20, timeout=(3.05, 30))
+    """
+    global _session
+    unknown = set(kwargs) - set(session_config)
+    if unknown:
+        raise TypeError(f"Unknown session config: {', '.join(sorted(unknown))}")
+    with _session_lock:
+        session_config.update(kwargs)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session() -> requests.Session:
+    """Returns the session shared by all request classes of the process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session(**session_config)
+        return _session
+
+
+def get_timeout() -> tuple:
+    return session_config["timeout"]
+
+
+def configure_base_urls(**kwargs) -> None:
+    """
+    >>> configure_base_urls(accounts="http://127.0.0.1:8000",
+    ...                     api="http://127.0.0.1:8000")
+    """
+    unknown = set(kwargs) - set(base_urls)
+    if unknown:
+        raise TypeError(f"Unknown base url: {', '.join(sorted(unknown))}")
+    base_urls.update(kwargs)
@@ -0,0 +1,239 @@
+"""
+Run timeline analyzer of spotify_app.log.
+
+Reads the log files lazily, line by line (plain or gzipped, rotated files
+included), groups the lines into runs that start at each
+"Spotify App executed" line and reports:
+
+    -> per-stage latency distribution (p50/p95/p99/max), the time between a
+       request line and the previous line of the same run
+    -> failure rates by stage and exception type / status code
+    -> runs and successful runs over time
+
+    python log_analyzer.py spotify_app.log
+    python log_analyzer.py 'logs/spotify_app.log*' --period month --json
+
+Memory does not grow with the log size: latencies are kept in fixed
+bucket histograms and counters are kept per stage and per period.
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from datetime import datetime
+from metrics import Histogram
+
+
+RUN_START = "Spotify App executed"
+
+# 2021-06-14 18:24:51,224 : INFO : custom_exception_check : request_status=...
+_line_pattern = re.compile(
+    r"^(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) : (?P<level>\w+) : "
+    r"(?P<name>[^:]+) : (?P<message>.*)$")
+_field_pattern = re.compile(r"([\w.]+)=([^,]*)")
+
+
+def parse_line(line: str):
+    """
+    Argument :
+        line (str) : text log line or json log line
+                     (custom_exception_check.configure_logging(json_format=True))
+
+    Returns  :
+        (timestamp, fields) : datetime and the key=value fields of the
+                              message; fields['message'] is the whole message
+        None                : if the line is not a log record
+    """
+    if line.startswith("{"):
+        try:
+            record = json.loads(line)
+            timestamp = datetime.strptime(record["time"],
+                                          "%Y-%m-%dT%H:%M:%S.%fZ")
+        except (ValueError, KeyError):
+            return None
+        message, level = record.get("message", ""), record.get("level")
+    else:
+        match = _line_pattern.match(line.rstrip("\n"))
+        if match is None:
+            return None
+        timestamp = datetime.strptime(match.group("time"),
+                                      "%Y-%m-%d %H:%M:%S,%f")
+        message, level = match.group("message"), match.group("level")
+    fields = dict((key, value.strip())
+                  for key, value in _field_pattern.findall(message))
+    fields["message"] = message
+    fields["level"] = level
+    return timestamp, fields
+
+
+def expand_paths(paths) -> list:
+    """
+    Expands the glob patterns and adds the rotated files of each log file
+    (spotify_app.log.1, spotify_app.log.2.gz, spotify_app.log.2021-06-14,
+    ...). Files are ordered from the oldest to the newest.
+    """
+    files = set()
+    for path in paths:
+        matches = glob.glob(path) or [path]
+        for match in matches:
+            files.add(match)
+            files.update(glob.glob(glob.escape(match) + ".*"))
+    files = [path for path in files if os.path.isfile(path)]
+    return sorted(files, key=os.path.getmtime)
+
+
+def open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, encoding="utf-8", errors="replace")
+
+
+def iter_records(paths):
+    """Generator of the parsed records of all files, one line at a time."""
+    for path in expand_paths(paths):
+        with open_log(path) as f:
+            for line in f:
+                record = parse_line(line)
+                if record is not None:
+                    yield record
+
+
+class RunAnalyzer(object):
+    """
+    Argument :
+        period (str) : 'day', 'month' or 'year', throughput granularity
+    """
+
+    period_formats = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+    def __init__(self, period: str = "day"):
+        self.period_format = self.period_formats[period]
+        self.stage_latency = defaultdict(Histogram)    # stage: Histogram
+        self.stage_requests = Counter()                # stage: count
+        self.stage_failures = Counter()                # (stage, kind): count
+        self.period_runs = Counter()                   # period: count
+        self.period_successes = Counter()
+        self.run_duration = Histogram()
+        self.runs = 0
+        self._run_start = None
+        self._previous = None
+        self._run_failed = False
+        self._run_succeeded = False
+
+    def _close_run(self) -> None:
+        if self._run_start is None:
+            return
+        period = self._run_start.strftime(self.period_format)
+        self.period_runs[period] += 1
+        if self._run_succeeded and not self._run_failed:
+            self.period_successes[period] += 1
+        self.run_duration.observe(
+            (self._previous - self._run_start).total_seconds())
+        self._run_start = None
+
+    def feed(self, timestamp: datetime, fields: dict) -> None:
+        if fields["message"].startswith(RUN_START):
+            self._close_run()
+            self.runs += 1
+            self._run_start = self._previous = timestamp
+            self._run_failed = self._run_succeeded = False
+            return
+        stage = fields.get("request_from")
+        if stage is None or self._run_start is None:
+            return
+        self.stage_requests[stage] += 1
+        self.stage_latency[stage].observe(
+            (timestamp - self._previous).total_seconds())
+        self._previous = timestamp
+        status = fields.get("request_status")
+        if status == "SUCCESS":
+            # a run is successful when the track is added to the playlist
+            if fields.get("status_code") == "201":
+                self._run_succeeded = True
+        else:
+            kind = fields.get("requests.exception") or \
+                f"status_code={fields.get('status_code')}"
+            self.stage_failures[(stage, kind)] += 1
+            self._run_failed = True
+
+    def finish(self) -> None:
+        self._close_run()
+
+    def report(self) -> dict:
+        stages = {}
+        for stage, histogram in sorted(self.stage_latency.items()):
+            failures = {kind: count for (name, kind), count
+                        in sorted(self.stage_failures.items()) if name == stage}
+            stages[stage] = {
+                "requests": self.stage_requests[stage],
+                "p50_ms": round(histogram.percentile(50) * 1000, 1),
+                "p95_ms": round(histogram.percentile(95) * 1000, 1),
+                "p99_ms": round(histogram.percentile(99) * 1000, 1),
+                "max_ms": round(histogram.max * 1000, 1),
+                "failure_rate": round(
+                    sum(failures.values()) / self.stage_requests[stage], 4),
+                "failures": failures,
+                }
+        return {
+            "runs": self.runs,
+            "run_duration_p50_ms": round(self.run_duration.percentile(50) * 1000, 1),
+            "run_duration_p95_ms": round(self.run_duration.percentile(95) * 1000, 1),
+            "stages": stages,
+            "throughput": {
+                period: {"runs": self.period_runs[period],
+                         "successful_runs": self.period_successes[period]}
+                for period in sorted(self.period_runs)
+                },
+            }
+
+
+def analyze(paths, period: str = "day") -> dict:
+    analyzer = RunAnalyzer(period)
+    for timestamp, fields in iter_records(paths):
+        analyzer.feed(timestamp, fields)
+    analyzer.finish()
+    return analyzer.report()
+
+
+def format_report(report: dict) -> str:
+    lines = [f"runs: {report['runs']}  "
+             f"run duration p50={report['run_duration_p50_ms']}ms "
+             f"p95={report['run_duration_p95_ms']}ms",
+             "",
+             f"{'stage':45} {'requests':>8} {'p50':>8} {'p95':>8} "
+             f"{'p99':>8} {'max':>8} {'failed':>7}"]
+    for stage, stats in report["stages"].items():
+        lines.append(
+            f"{stage:45} {stats['requests']:8d} {stats['p50_ms']:8.1f} "
+            f"{stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f} "
+            f"{stats['max_ms']:8.1f} {stats['failure_rate']:7.1%}")
+        for kind, count in stats["failures"].items():
+            lines.append(f"    {kind}: {count}")
+    lines += ["", f"{'period':12} {'runs':>6} {'successful':>10}"]
+    for period, stats in report["throughput"].items():
+        lines.append(f"{period:12} {stats['runs']:6d} "
+                     f"{stats['successful_runs']:10d}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('paths', nargs='*', default=['spotify_app.log'],
+                        help='log files or glob patterns')
+    parser.add_argument('--period', choices=('day', 'month', 'year'),
+                        default='day')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+    report = analyze(args.paths, args.period)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
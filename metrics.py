@@ -0,0 +1,333 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+
+# upper bounds of the latency buckets in seconds (Prometheus 'le' labels)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3,
+                   0.4, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# spotify ids are 22 character base62 strings
+_spotify_id = re.compile(r"^[0-9A-Za-z]{22}$")
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram. Memory does not grow with the number of the
+    observations. Percentiles are interpolated inside the bucket.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        """p between 0 and 100. Returns 0.0 if there is no observation."""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                value = lower + (upper - lower) * (rank - cumulative) / count
+                return min(value, self.max)
+            cumulative += count
+        return self.max
+
+
+def normalize_endpoint(url: str) -> str:
+    """
+    >>> normalize_endpoint(
+    ...     "https://api.spotify.com/v1/playlists/7xA9OjNeAAaBvZ2WJLHbDT/tracks")
+    'api.spotify.com/v1/playlists/{id}/tracks'
+    """
+    parts = urlsplit(url)
+    path = "/".join("{id}" if _spotify_id.match(segment) else segment
+                    for segment in parts.path.split("/"))
+    return parts.netloc + path
+
+
+class RequestMetrics(object):
+    """
+    Records wall time, response size, status code and retry count of every
+    request sent by request_call_with_exception_check.
+
+        -> in-process latency histograms per endpoint (p50/p95/p99)
+        -> structured json lines, one line per request ('jsonl_path')
+        -> Prometheus textfile ('prometheus_path', rewritten at most once
+           per 'prometheus_interval' seconds and at exit)
+
+    Writing to files is disabled while the paths are None. The json lines
+    are put into a queue and written by a QueueListener thread, the
+    requests do not wait for the disk. Errors of the metric files are
+    logged, they are not raised into the request.
+    """
+
+    def __init__(self, jsonl_path: str = None, prometheus_path: str = None,
+                 prometheus_interval: float = 1.0):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.prometheus_interval = prometheus_interval
+        self.histograms = {}        # endpoint: Histogram
+        self.status_counts = {}     # (endpoint, status): count
+        self.bytes_total = {}       # endpoint: bytes
+        self._prometheus_written = 0.0
+        self._lock = threading.Lock()
+        # one textfile writer at a time, check write_prometheus_textfile
+        self._prometheus_lock = threading.Lock()
+        self._jsonl_logger = None
+        self._jsonl_listener = None
+        self._jsonl_lock = threading.Lock()
+
+    def start_jsonl(self):
+        """
+        Sets up the queue and the listener of the json lines if they are
+        not running, called on the first observation.
+
+        Returns  :
+            jsonl_logger (logging.Logger) : None if 'jsonl_path' is None
+        """
+        with self._jsonl_lock:
+            if self._jsonl_logger is not None or not self.jsonl_path:
+                return self._jsonl_logger
+            file_handler = logging.FileHandler(self.jsonl_path,
+                                               encoding="utf-8", delay=True)
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            log_queue = queue.SimpleQueue()
+            # not registered in the logging tree, the records of every
+            # RequestMetrics object go only to its own file
+            jsonl_logger = logging.Logger(f"{__name__}.requests")
+            jsonl_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            self._jsonl_listener = logging.handlers.QueueListener(
+                                        log_queue, file_handler)
+            self._jsonl_listener.start()
+            self._jsonl_logger = jsonl_logger
+            return jsonl_logger
+
+    def stop_jsonl(self) -> None:
+        """Writes the queued json lines and closes the file."""
+        with self._jsonl_lock:
+            self._stop_jsonl()
+
+    def _stop_jsonl(self) -> None:
+        if self._jsonl_listener is not None:
+            self._jsonl_listener.stop()
+            for handler in self._jsonl_listener.handlers:
+                handler.close()
+        self._jsonl_logger = self._jsonl_listener = None
+
+    def observe(self, request_from: str, duration: float, response=None,
+                exception=None) -> None:
+        """
+        Argument :
+            request_from (str) : e.g. "Spochastify.post_search_request"
+            duration (float)   : wall time in seconds, including the retries
+            response           : response object (None if exception raised)
+            exception          : requests exception
+        """
+        url, method, status, size, retries = '', '', None, 0, 0
+        if response is not None:
+            request = response.request
+            url, method = response.url, request.method if request else ''
+            status = response.status_code
+            size = len(response.content or b'')
+            retries = getattr(response, 'retries', 0)
+        elif exception is not None and exception.request is not None:
+            url, method = exception.request.url, exception.request.method
+        endpoint = normalize_endpoint(url) if url else request_from
+        status_label = str(status) if status is not None else type(exception).__name__
+
+        with self._lock:
+            histogram = self.histograms.get(endpoint)
+            if histogram is None:
+                histogram = self.histograms[endpoint] = Histogram()
+            histogram.observe(duration)
+            key = (endpoint, status_label)
+            self.status_counts[key] = self.status_counts.get(key, 0) + 1
+            self.bytes_total[endpoint] = self.bytes_total.get(endpoint, 0) + size
+            now = time.monotonic()
+            write_prometheus = (
+                self.prometheus_path and
+                now - self._prometheus_written >= self.prometheus_interval)
+            if write_prometheus:
+                # the other threads do not write it in the same interval
+                self._prometheus_written = now
+
+        if self.jsonl_path:
+            jsonl_logger = self._jsonl_logger or self.start_jsonl()
+            if jsonl_logger is not None:
+                jsonl_logger.info(json.dumps({
+                    "ts": time.time(),
+                    "request_from": request_from,
+                    "endpoint": endpoint,
+                    "method": method,
+                    "status": status_label,
+                    "duration_ms": round(duration * 1000, 3),
+                    "bytes": size,
+                    "retries": retries,
+                    }))
+        if write_prometheus:
+            self.write_prometheus_textfile(blocking=False)
+
+    def summary(self) -> dict:
+        """
+        Returns  :
+            {endpoint: {'count', 'p50', 'p95', 'p99', 'max', 'bytes'}}
+            latencies in milliseconds
+        """
+        with self._lock:
+            return {
+                endpoint: {
+                    'count': histogram.count,
+                    'p50': round(histogram.percentile(50) * 1000, 1),
+                    'p95': round(histogram.percentile(95) * 1000, 1),
+                    'p99': round(histogram.percentile(99) * 1000, 1),
+                    'max': round(histogram.max * 1000, 1),
+                    'bytes': self.bytes_total.get(endpoint, 0),
+                    }
+                for endpoint, histogram in self.histograms.items()
+                }
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP spotify_request_duration_seconds Request wall time.",
+            "# TYPE spotify_request_duration_seconds histogram",
+            ]
+        with self._lock:
+            for endpoint, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f'spotify_request_duration_seconds_bucket'
+                        f'{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'spotify_request_duration_seconds_sum'
+                             f'{{endpoint="{endpoint}"}} {histogram.sum}')
+                lines.append(f'spotify_request_duration_seconds_count'
+                             f'{{endpoint="{endpoint}"}} {histogram.count}')
+            lines += [
+                "# HELP spotify_request_duration_quantile_seconds"
+                " Interpolated latency percentiles.",
+                "# TYPE spotify_request_duration_quantile_seconds gauge",
+                ]
+            for endpoint, histogram in sorted(self.histograms.items()):
+                for quantile in (50, 95, 99):
+                    lines.append(
+                        f'spotify_request_duration_quantile_seconds'
+                        f'{{endpoint="{endpoint}",quantile="0.{quantile}"}}'
+                        f' {histogram.percentile(quantile)}')
+            lines += [
+                "# HELP spotify_requests_total Requests by status code"
+                " or exception name.",
+                "# TYPE spotify_requests_total counter",
+                ]
+            for (endpoint, status), count in sorted(self.status_counts.items()):
+                lines.append(f'spotify_requests_total'
+                             f'{{endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += [
+                "# HELP spotify_response_bytes_total Response body bytes.",
+                "# TYPE spotify_response_bytes_total counter",
+                ]
+            for endpoint, size in sorted(self.bytes_total.items()):
+                lines.append(f'spotify_response_bytes_total'
+                             f'{{endpoint="{endpoint}"}} {size}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self, path: str = None,
+                                  blocking: bool = True) -> bool:
+        """
+        Writes the metrics for the node_exporter textfile collector.
+
+        The text is written to a unique temporary file in the same
+        directory and renamed over 'path', so the collector never reads a
+        partial file. One thread writes at a time; with blocking=False the
+        call returns at once if another thread is writing.
+
+        Returns  :
+            written (bool) : False if it is skipped or failed (the error is
+                             logged, not raised)
+        """
+        path = path or self.prometheus_path
+        if not path:
+            return False
+        if not self._prometheus_lock.acquire(blocking=blocking):
+            return False
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=f".{os.path.basename(path)}.", suffix=".tmp",
+                dir=os.path.dirname(path) or ".")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.prometheus_text())
+            # mkstemp creates the file readable by the owner only
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+            tmp_path = None
+            self._prometheus_written = time.monotonic()
+            return True
+        except OSError as e:
+            logging.getLogger(__name__).warning(
+                "Prometheus textfile %s is not written: %s", path, e)
+            return False
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            self._prometheus_lock.release()
+
+
+METRICS_PATH = 'spotify_app_metrics.jsonl'
+
+# in-process histograms only; the json lines (one line per request, the
+# file is not rotated) and the textfile are written after 'configure'
+request_metrics = RequestMetrics()
+
+
+def configure(jsonl_path: str = METRICS_PATH, prometheus_path: str = None,
+              prometheus_interval: float = 1.0) -> RequestMetrics:
+    """
+    Enables the metric files, they are not written by default.
+
+    >>> configure(jsonl_path="spotify_app_metrics.jsonl",
+    ...           prometheus_path="/var/lib/node_exporter/spotify_app.prom")
+
+    The json lines file grows with every request and is not rotated by
+    the application; jsonl_path=None writes only the Prometheus textfile.
+    """
+    request_metrics.jsonl_path = jsonl_path
+    request_metrics.prometheus_path = prometheus_path
+    request_metrics.prometheus_interval = prometheus_interval
+    # json lines go to the new path from now on
+    request_metrics.stop_jsonl()
+    return request_metrics
+
+
+@atexit.register
+def _write_metrics_at_exit():
+    # writes the queued json lines before the interpreter exits
+    request_metrics.stop_jsonl()
+    if request_metrics.prometheus_path and request_metrics.histograms:
+        request_metrics.write_prometheus_textfile()
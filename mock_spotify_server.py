@@ -0,0 +1,401 @@
+"""
+Local stand-in of the Spotify Web API for offline benchmarks.
+
+Serves the endpoints that are used by the application:
+
+    POST /api/token                  -> access token
+    GET  /v1/search                  -> a page of generated track items
+    GET  /v1/tracks?ids=             -> full track objects (max. 50 ids)
+    GET  /v1/audio-features?ids=     -> audio features (max. 100 ids)
+    POST /v1/playlists/{id}/tracks   -> 201 with a snapshot_id
+
+Latency, 500 errors, 429 responses (with Retry-After) and the size of the
+search payload are configurable. Point the application at it with
+http_session.configure_base_urls:
+
+    server = MockSpotifyServer(latency=0.02, error_rate=0.01)
+    base_url = server.start()
+    http_session.configure_base_urls(accounts=base_url, api=base_url)
+    ...
+    server.stop()
+
+    python mock_spotify_server.py --port 8000 --latency 0.05
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+
+_base62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+_playlist_tracks_path = re.compile(r"^/v1/playlists/([^/]+)/tracks$")
+# maximum number of ids of the multi-id endpoints
+_ids_limits = {"tracks": 50, "audio_features": 100}
+# ISO 3166-1 alpha-2 like codes of 'available_markets'
+_markets = [a + b for a in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+            for b in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+
+
+def spotify_id(seed: str) -> str:
+    """Deterministic 22 character base62 id of a seed string."""
+    number = int.from_bytes(hashlib.blake2b(seed.encode(),
+                                            digest_size=16).digest(), "big")
+    characters = []
+    for i in range(22):
+        number, remainder = divmod(number, 62)
+        characters.append(_base62[remainder])
+    return "".join(characters)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    # keep-alive connections, like the Spotify API
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, no delayed ack wait between them
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, body: dict, headers=None) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def handle_request(self, method: str) -> None:
+        mock = self.server.mock
+        parts = urlsplit(self.path)
+        body = self.read_body()
+        if parts.path == "/api/token" and method == "POST":
+            endpoint = "token"
+        elif parts.path == "/v1/search" and method == "GET":
+            endpoint = "search"
+        elif parts.path == "/v1/tracks" and method == "GET":
+            endpoint = "tracks"
+        elif parts.path == "/v1/audio-features" and method == "GET":
+            endpoint = "audio_features"
+        elif _playlist_tracks_path.match(parts.path) and method == "POST":
+            endpoint = "playlist_tracks"
+        else:
+            mock.count("not_found")
+            self.send_json(404, {"error": {"status": 404,
+                                           "message": "Service not found"}})
+            return
+
+        fault = mock.delay_and_pick_fault(endpoint)
+        if fault == 429:
+            self.send_json(429, {"error": {"status": 429,
+                                           "message": "API rate limit exceeded"}},
+                           {"Retry-After": str(mock.retry_after)})
+            return
+        if fault is not None:
+            self.send_json(fault, {"error": {"status": fault,
+                                             "message": "Server error"
+                                             if fault >= 500 else "Error"}})
+            return
+
+        query = parse_qs(parts.query)
+        if endpoint == "token":
+            self.send_json(200, mock.token_body())
+        elif endpoint == "search":
+            host = self.headers.get("Host", "127.0.0.1")
+            self.send_json(200, mock.search_body(query, f"http://{host}"))
+        elif endpoint in _ids_limits:
+            ids = [track_id for track_id
+                   in query.get("ids", [""])[0].split(",") if track_id]
+            if not 0 < len(ids) <= _ids_limits[endpoint]:
+                self.send_json(400, {"error": {"status": 400,
+                                               "message": "Invalid ids"}})
+            elif endpoint == "tracks":
+                self.send_json(200, mock.tracks_body(ids))
+            else:
+                self.send_json(200, mock.audio_features_body(ids))
+        else:
+            uris = query.get("uris", [])
+            if body:
+                try:
+                    uris = json.loads(body).get("uris", uris)
+                except ValueError:
+                    pass
+            self.send_json(201, mock.add_tracks_body(uris))
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class MockSpotifyServer(object):
+    """
+    Argument :
+        latency (float)         : seconds slept before each response
+        jitter (float)          : random extra latency, 0 - jitter seconds
+        error_rate (float)      : probability of a 500 response
+        rate_limit_rate (float) : probability of a 429 response
+        retry_after (float)     : Retry-After header of the 429 responses
+        total (int)             : 'total' of each search result
+        markets_per_item (int)  : length of 'available_markets' of each item,
+                                  the main part of the search payload size
+        empty_rate (float)      : probability of an empty search result
+        expires_in (int)        : lifetime of the access tokens in seconds
+        seed (int)              : seed of the fault and empty result draws
+        endpoint_status (dict)  : fixed error status of an endpoint, e.g.
+                                  {'playlist_tracks': 403} (refused add)
+        host, port              : port 0 picks a free port
+
+    self.requests is a Counter of the served requests by endpoint and
+    self.added_uris is the number of the uris added to playlists.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1, total: int = 1000,
+                 markets_per_item: int = 180, empty_rate: float = 0.0,
+                 expires_in: int = 3600, seed: int = None,
+                 endpoint_status: dict = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.total = total
+        self.markets_per_item = min(markets_per_item, len(_markets))
+        self.empty_rate = empty_rate
+        self.expires_in = expires_in
+        self.endpoint_status = dict(endpoint_status or {})
+        self.host = host
+        self.port = port
+        self.requests = Counter()
+        self.added_uris = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        """Serves in a background thread. Returns the base url."""
+        self._httpd = ThreadingHTTPServer((self.host, self.port), MockHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name="mock-spotify-server",
+                                        daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._thread.join()
+            self._httpd = self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, endpoint: str) -> None:
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def delay_and_pick_fault(self, endpoint: str):
+        """Sleeps the latency. Returns an error status or None."""
+        with self._lock:
+            self.requests[endpoint] += 1
+            jitter = self._random.uniform(0, self.jitter) if self.jitter else 0
+            draw = self._random.random()
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+        if endpoint in self.endpoint_status:
+            return self.endpoint_status[endpoint]
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def token_body(self) -> dict:
+        with self._lock:
+            token_number = self.requests["token"]
+        return {
+            "access_token": f"mock-access-token-{token_number}",
+            "token_type": "Bearer",
+            "scope": "playlist-modify-public",
+            "expires_in": self.expires_in,
+            }
+
+    def track_item(self, seed: str) -> dict:
+        track_id = spotify_id(seed)
+        album_id = spotify_id("album:" + seed)
+        artist_id = spotify_id("artist:" + seed)
+        markets = _markets[:self.markets_per_item]
+        return {
+            "album": {
+                "album_type": "album",
+                "available_markets": markets,
+                "external_urls": {
+                    "spotify": f"https://open.spotify.com/album/{album_id}"},
+                "id": album_id,
+                "name": f"Album {album_id[:6]}",
+                "type": "album",
+                "uri": f"spotify:album:{album_id}",
+                },
+            "artists": [{
+                "external_urls": {
+                    "spotify": f"https://open.spotify.com/artist/{artist_id}"},
+                "id": artist_id,
+                "name": f"Artist {artist_id[:6]}",
+                "type": "artist",
+                "uri": f"spotify:artist:{artist_id}",
+                }],
+            "available_markets": markets,
+            "disc_number": 1,
+            "duration_ms": 180000 + int(track_id[:3], 36) % 120000,
+            "explicit": False,
+            "external_ids": {"isrc": "XX" + track_id[:10].upper()},
+            "external_urls": {
+                "spotify": f"https://open.spotify.com/track/{track_id}"},
+            "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+            "id": track_id,
+            "is_local": False,
+            "name": f"Track {track_id[:6]}",
+            "popularity": int(track_id[:2], 36) % 101,
+            "preview_url": None,
+            "track_number": 1,
+            "type": "track",
+            "uri": f"spotify:track:{track_id}",
+            }
+
+    def search_body(self, query: dict, base_url: str) -> dict:
+        search_word = query.get("q", [""])[0]
+        limit = int(query.get("limit", ["20"])[0])
+        offset = int(query.get("offset", ["0"])[0])
+        with self._lock:
+            empty = self._random.random() < self.empty_rate
+        total = 0 if empty else self.total
+        count = max(0, min(limit, total - offset))
+        items = [self.track_item(f"{search_word}:{offset + i}")
+                 for i in range(count)]
+        next_url = None
+        if offset + count < total:
+            next_url = base_url + "/v1/search?" + urlencode({
+                "q": search_word, "type": "track",
+                "limit": limit, "offset": offset + count})
+        return {"tracks": {
+            "href": base_url + "/v1/search?" + urlencode(
+                {"q": search_word, "type": "track",
+                 "limit": limit, "offset": offset}),
+            "items": items,
+            "limit": limit,
+            "next": next_url,
+            "offset": offset,
+            "previous": None,
+            "total": total,
+            }}
+
+    def tracks_body(self, track_ids) -> dict:
+        """Generated full track objects with the requested ids."""
+        tracks = []
+        for track_id in track_ids:
+            item = self.track_item("id:" + track_id)
+            item.update({
+                "id": track_id,
+                "uri": f"spotify:track:{track_id}",
+                "href": f"https://api.spotify.com/v1/tracks/{track_id}",
+                "external_urls": {
+                    "spotify": f"https://open.spotify.com/track/{track_id}"},
+                })
+            tracks.append(item)
+        return {"tracks": tracks}
+
+    def audio_features_body(self, track_ids) -> dict:
+        features = []
+        for track_id in track_ids:
+            draw = random.Random(track_id)
+            features.append({
+                "acousticness": round(draw.random(), 4),
+                "analysis_url":
+                    f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+                "danceability": round(draw.random(), 3),
+                "duration_ms": draw.randint(120000, 300000),
+                "energy": round(draw.random(), 3),
+                "id": track_id,
+                "instrumentalness": round(draw.random(), 4),
+                "key": draw.randint(-1, 11),
+                "liveness": round(draw.random(), 4),
+                "loudness": round(draw.uniform(-30, 0), 3),
+                "mode": draw.randint(0, 1),
+                "speechiness": round(draw.random(), 4),
+                "tempo": round(draw.uniform(60, 200), 3),
+                "time_signature": draw.randint(3, 7),
+                "track_href": f"https://api.spotify.com/v1/tracks/{track_id}",
+                "type": "audio_features",
+                "uri": f"spotify:track:{track_id}",
+                "valence": round(draw.random(), 3),
+                })
+        return {"audio_features": features}
+
+    def add_tracks_body(self, uris) -> dict:
+        if isinstance(uris, str):
+            uris = uris.split(",")
+        with self._lock:
+            self.added_uris += len(uris)
+            snapshot_number = self.requests["playlist_tracks"]
+        return {"snapshot_id": spotify_id(f"snapshot:{snapshot_number}")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1)
+    parser.add_argument('--markets', type=int, default=180,
+                        help='available_markets per search item')
+    parser.add_argument('--empty-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = MockSpotifyServer(latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate,
+                               rate_limit_rate=args.rate_limit_rate,
+                               retry_after=args.retry_after,
+                               markets_per_item=args.markets,
+                               empty_rate=args.empty_rate,
+                               host=args.host, port=args.port)
+    print(f"serving on {server.start()}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
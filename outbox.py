@@ -0,0 +1,405 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+import api_task_requests
+import database_update
+from pipeline import batches
+from track_record import Track
+
+
+OUTBOX_PATH = 'track_outbox.sql'
+
+sql_outbox_create = """
+CREATE TABLE IF NOT EXISTS Outbox(
+        id INTEGER NOT NULL PRIMARY KEY,
+        playlist_id TEXT NOT NULL,
+        artist_name TEXT,
+        album_name TEXT,
+        track_name TEXT,
+        track_external_url TEXT,
+        track_uri TEXT NOT NULL,
+        search_word TEXT,
+        add_status TEXT NOT NULL DEFAULT 'pending',
+        insert_status TEXT NOT NULL DEFAULT 'pending',
+        added_at TEXT,
+        snapshot_id TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL,
+        UNIQUE(playlist_id, track_uri)
+)
+"""
+
+sql_outbox_index = """
+CREATE INDEX IF NOT EXISTS idx_outbox_status
+    ON Outbox(add_status, insert_status)
+"""
+
+# 'put' looks up the track in the entries of all playlists
+sql_outbox_track_index = """
+CREATE INDEX IF NOT EXISTS idx_outbox_track_uri ON Outbox(track_uri)
+"""
+
+_entry_columns = ("id, playlist_id, artist_name, album_name, track_name,"
+                  " track_external_url, track_uri, search_word, add_status,"
+                  " insert_status, added_at, attempts")
+
+
+def is_rejected(status_code) -> bool:
+    """
+    True if a failed add request would fail again with the same tracks:
+    4xx except 401 (expired token, a new one is requested by the next run)
+    and 429 (rate limited). None (exception catched) and 5xx are transient.
+    """
+    return (status_code is not None and 400 <= status_code < 500
+            and status_code not in (401, 429))
+
+
+class OutboxEntry(NamedTuple):
+    id: int
+    playlist_id: str
+    track: Track
+    search_word: str
+    add_status: str         # 'pending', 'done' or 'rejected'
+    insert_status: str      # 'pending' or 'done'
+    added_at: str           # playlist add time, date_time of Random_Tracks
+    attempts: int           # failed add requests (transient failures)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'OutboxEntry':
+        return cls(row[0], row[1], Track(*row[2:7]), *row[7:])
+
+
+class Outbox(object):
+    """
+    Durable record of the chosen tracks and of the steps done for them.
+
+        1. put         : track is chosen          (add and insert pending)
+        2. flush_adds  : added to the playlist    (add done)
+        3. flush_inserts : written to Random_Tracks (insert done)
+
+    The entries are kept in a local SQLite file. When a run fails after the
+    track is chosen (e.g. the add request fails or the database write
+    raises), the next run (the Airflow retry) finds the incomplete entry and
+    continues from the step that is not done. The track is not searched
+    again.
+
+    An add that received 201 is not sent again. A single add request is
+    sent once, as the POST is not retried by the session adapter (GET
+    only, check http_session) nor on 5xx by the scheduler (idempotent=False,
+    check rate_limiter). The add state is saved after the response is
+    received; if the process is killed between the two, the add is sent
+    again by the next run (at least once).
+
+    A failed add is retried by the next runs only if the failure is
+    transient (no response, 5xx, 429 or 401 expired token). Any other 4xx
+    (bad request, unknown playlist, no permission) would fail the same
+    way again: the entries are 'rejected' at once and not sent again.
+
+    Adds are sent 100 tracks per request and inserts are written in one
+    transaction per flush. OutboxFlusher flushes in a background thread.
+
+    Argument :
+        max_attempts (int) : transient add failures after which an entry is
+                             not sent again automatically
+    """
+
+    def __init__(self, path: str = OUTBOX_PATH, max_attempts: int = 5):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(sql_outbox_create)
+            self.conn.execute(sql_outbox_index)
+            self.conn.execute(sql_outbox_track_index)
+
+    def _select(self, where: str, params=()) -> list:
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT {_entry_columns} FROM Outbox WHERE {where}"
+                " ORDER BY id", params).fetchall()
+        return [OutboxEntry.from_row(row) for row in rows]
+
+    def put(self, playlist_id: str, track: Track, search_word: str) -> bool:
+        """
+        Records a chosen track. A track already in the outbox is kept.
+
+        A track is added to one playlist only, as the seen tracks are
+        shared by the playlists. The parallel playlist tasks load their
+        seen tracks at start and can choose the same track; the check and
+        the insert are one statement, so only the first task records it.
+        An entry that is rejected by another playlist does not block the
+        track.
+
+        Returns  :
+            inserted (bool) : False if the track is already in the outbox
+                              (nothing is recorded)
+        """
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "INSERT INTO Outbox (playlist_id, artist_name, album_name,"
+                " track_name, track_external_url, track_uri, search_word,"
+                " created) SELECT ?, ?, ?, ?, ?, ?, ?, ?"
+                " WHERE NOT EXISTS (SELECT 1 FROM Outbox WHERE track_uri = ?"
+                " AND add_status != 'rejected')"
+                " ON CONFLICT(playlist_id, track_uri) DO NOTHING",
+                (playlist_id, *track, search_word, time.time(),
+                 track.track_uri)).rowcount == 1
+
+    def entry(self, playlist_id: str, track_uri: str):
+        """Returns the OutboxEntry of the track or None."""
+        entries = self._select("playlist_id = ? AND track_uri = ?",
+                               (playlist_id, track_uri))
+        return entries[0] if entries else None
+
+    def blocked_uris(self, playlist_id: str = None) -> set:
+        """
+        Returns  :
+            track_uris (set) : tracks that are not sent again, rejected or
+                               failed 'max_attempts' times. They are not
+                               chosen again: 'put' would not record them.
+        """
+        where = ("(add_status = 'rejected'"
+                 " OR (add_status = 'pending' AND attempts >= ?))")
+        params = (self.max_attempts,)
+        if playlist_id is not None:
+            where += " AND playlist_id = ?"
+            params += (playlist_id,)
+        with self._lock:
+            return {track_uri for (track_uri,) in self.conn.execute(
+                        f"SELECT track_uri FROM Outbox WHERE {where}", params)}
+
+    def incomplete(self, playlist_id: str = None) -> list:
+        """
+        Returns  :
+            entries (list) : OutboxEntry objects of which the add or the
+                             insert step is not done, oldest first
+                             (without the entries that failed
+                             'max_attempts' times)
+        """
+        where = ("((add_status = 'pending' AND attempts < ?)"
+                 " OR (add_status = 'done' AND insert_status = 'pending'))")
+        if playlist_id is None:
+            return self._select(where, (self.max_attempts,))
+        return self._select(where + " AND playlist_id = ?",
+                            (self.max_attempts, playlist_id))
+
+    def pending_adds(self, playlist_id: str = None) -> list:
+        where = "add_status = 'pending' AND attempts < ?"
+        if playlist_id is None:
+            return self._select(where, (self.max_attempts,))
+        return self._select(where + " AND playlist_id = ?",
+                            (self.max_attempts, playlist_id))
+
+    def pending_inserts(self) -> list:
+        return self._select(
+            "add_status = 'done' AND insert_status = 'pending'")
+
+    def mark_added(self, entry_ids, added_at: datetime,
+                   snapshot_id: str = None) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE Outbox SET add_status = 'done', added_at = ?,"
+                " snapshot_id = ? WHERE id = ?",
+                ((str(added_at), snapshot_id, entry_id)
+                 for entry_id in entry_ids))
+
+    def mark_failed(self, entry_ids) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE Outbox SET attempts = attempts + 1 WHERE id = ?",
+                ((entry_id,) for entry_id in entry_ids))
+
+    def mark_rejected(self, entry_ids) -> None:
+        """The add request is refused by the API, it is not sent again."""
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE Outbox SET add_status = 'rejected' WHERE id = ?",
+                ((entry_id,) for entry_id in entry_ids))
+
+    def mark_inserted(self, entry_ids) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE Outbox SET insert_status = 'done' WHERE id = ?",
+                ((entry_id,) for entry_id in entry_ids))
+
+    def flush_adds(self, spochastify, access_token_with_scope: str,
+                   playlist_id: str = None,
+                   batch_size: int = api_task_requests.PLAYLIST_ADD_LIMIT,
+                   min_batch: int = 1) -> list:
+        """
+        Sends the pending adds, 'batch_size' tracks per request. Stops at
+        the first failed request; its entries stay pending if the failure
+        is transient, otherwise they are rejected (check 'is_rejected').
+
+        Argument :
+            spochastify : api_task_requests.Spochastify object
+            playlist_id : only the entries of this playlist (None: all)
+            min_batch   : smaller batches are left pending
+
+        Returns  :
+            chunk_results (list) : Spochastify.add_tracks_to_playlist
+                                   results of the sent requests, with a
+                                   'playlist_id' key
+        """
+        entries = {}            # playlist_id: [OutboxEntry, ...]
+        for entry in self.pending_adds(playlist_id):
+            entries.setdefault(entry.playlist_id, []).append(entry)
+        chunk_results = []
+        for entry_playlist_id, playlist_entries in entries.items():
+            for batch in batches(playlist_entries, batch_size):
+                if len(batch) < min_batch:
+                    break
+                chunk = spochastify.add_tracks_to_playlist(
+                            access_token_with_scope,
+                            [entry.track.track_uri for entry in batch],
+                            entry_playlist_id,
+                            chunk_size=batch_size
+                            )[0]
+                chunk['chunk'] = len(chunk_results)
+                chunk['playlist_id'] = entry_playlist_id
+                chunk_results.append(chunk)
+                entry_ids = [entry.id for entry in batch]
+                if chunk['status_code'] != 201:
+                    if is_rejected(chunk['status_code']):
+                        self.mark_rejected(entry_ids)
+                    else:
+                        self.mark_failed(entry_ids)
+                    return chunk_results
+                # playlist add time. UTC +0
+                self.mark_added(entry_ids, datetime.now(timezone.utc),
+                                chunk['snapshot_id'])
+        return chunk_results
+
+    def flush_inserts(self, writer: database_update.TrackWriter = None) -> int:
+        """
+        Writes the added tracks that are not in Random_Tracks yet, in one
+        transaction.
+
+        Argument :
+            writer : database_update.TrackWriter, a new one is opened if None
+
+        Returns  :
+            count (int) : number of the written rows
+        """
+        entries = self.pending_inserts()
+        if not entries:
+            return 0
+        if writer is None:
+            with database_update.TrackWriter() as writer:
+                return self.flush_inserts(writer)
+        # date_time column has the str() of the add time
+        writer.write_many((entry.track, entry.added_at, entry.playlist_id)
+                          for entry in entries)
+        self.mark_inserted(entry.id for entry in entries)
+        return len(entries)
+
+    def flush(self, spochastify, access_token_with_scope: str,
+              playlist_id: str = None, writer=None, min_batch: int = 1) -> dict:
+        """
+        flush_adds and flush_inserts. Adds are skipped if the token is None.
+
+        Returns  :
+            {'chunk_results': [...], 'inserted': int}
+        """
+        chunk_results = []
+        if access_token_with_scope is not None:
+            chunk_results = self.flush_adds(spochastify,
+                                            access_token_with_scope,
+                                            playlist_id, min_batch=min_batch)
+        return {'chunk_results': chunk_results,
+                'inserted': self.flush_inserts(writer)}
+
+    def prune(self, max_age: float = 30 * 24 * 3600) -> int:
+        """Deletes the completed entries older than 'max_age' seconds."""
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM Outbox WHERE add_status = 'done'"
+                " AND insert_status = 'done' AND created < ?",
+                (time.time() - max_age,)).rowcount
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class OutboxFlusher(object):
+    """
+    Background thread that flushes the outbox every 'interval' seconds, or
+    as soon as 'batch_size' adds are pending, while the pipeline is still
+    choosing tracks. Adds are sent in full batches until 'stop'.
+
+        flusher = OutboxFlusher(outbox, spochastify, access_token_with_scope)
+        flusher.start()
+        ...                       # outbox.put(...)
+        flusher.stop()            # last flush
+        flusher.chunk_results     # sent add requests
+
+    After a failed add request no more adds are sent by the flusher; the
+    entries stay pending for the next run.
+    """
+
+    def __init__(self, outbox: Outbox, spochastify,
+                 access_token_with_scope: str, playlist_id: str = None,
+                 interval: float = 5.0,
+                 batch_size: int = api_task_requests.PLAYLIST_ADD_LIMIT):
+        self.outbox = outbox
+        self.spochastify = spochastify
+        self.access_token_with_scope = access_token_with_scope
+        self.playlist_id = playlist_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.chunk_results = []
+        self.inserted = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def add_failed(self) -> bool:
+        return any(chunk['status_code'] != 201 for chunk in self.chunk_results)
+
+    def notify(self) -> None:
+        """Wakes the flusher if a full batch is pending."""
+        if len(self.outbox.pending_adds(self.playlist_id)) >= self.batch_size:
+            self._wake.set()
+
+    def flush(self, min_batch: int = 1) -> None:
+        access_token_with_scope = None if self.add_failed \
+            else self.access_token_with_scope
+        # the database connection of the writer belongs to this thread
+        result = self.outbox.flush(self.spochastify, access_token_with_scope,
+                                   self.playlist_id, min_batch=min_batch)
+        for chunk in result['chunk_results']:
+            chunk['chunk'] = len(self.chunk_results)
+            self.chunk_results.append(chunk)
+        self.inserted += result['inserted']
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                # only full batches, the rest is sent by 'stop'
+                self.flush(min_batch=self.batch_size)
+            except Exception:
+                # e.g. database is locked, the entries stay in the outbox
+                # and are flushed again by the next flush or by 'stop'
+                pass
+
+    def start(self) -> 'OutboxFlusher':
+        self._thread = threading.Thread(target=self._run,
+                                        name="outbox-flusher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops the thread and flushes the remaining entries."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
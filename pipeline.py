@@ -0,0 +1,217 @@
+import queue
+import threading
+from itertools import islice
+
+
+class StopPipeline(Exception):
+    """
+    Raised by a stage function to stop the whole pipeline, e.g. on a failed
+    request. Pipeline.run raises it to the caller; 'value' is the return
+    value of the caller (e.g. the failed response object).
+    """
+
+    def __init__(self, value=None):
+        super().__init__(value)
+        self.value = value
+
+
+_done = object()
+
+
+class _Failure(object):
+    """Exception of a worker thread, raised again in the consumer thread."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+def batches(items, size: int):
+    """Yields lists of 'size' items (last one may be shorter)."""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Stage(object):
+    """
+    One step of a Pipeline.
+
+    Argument :
+        name (str)
+        function          : function(item) or function(batch) if
+                            batch_size > 1. Returns the output items of the
+                            stage as an iterable (a generator function, a
+                            list, ...) or None for no output.
+        concurrency (int) : 1 runs the function in the thread that consumes
+                            the stage, lazily: an item is pulled from the
+                            previous stage only when an output is needed.
+                            n > 1 runs the function in n worker threads;
+                            outputs are handed over through a bounded queue
+                            in completion order.
+        batch_size (int)  : items per function call, the last batch is
+                            flushed when the previous stage is exhausted
+        limit (int)       : the stage stops after this many outputs and
+                            closes the previous stages
+        queue_size (int)  : size of the output queue of the worker threads,
+                            default 2 * concurrency
+        wait_in_flight (bool) : when the stage is closed (e.g. a later stage
+                            reached its limit), wait for the calls in
+                            flight of the worker threads. False returns at
+                            once; the calls in flight finish in the
+                            background (daemon threads) and their outputs
+                            are dropped, e.g. the slower searches after
+                            the first hit.
+    """
+
+    def __init__(self, name: str, function, concurrency: int = 1,
+                 batch_size: int = 1, limit: int = None,
+                 queue_size: int = None, wait_in_flight: bool = True):
+        if concurrency < 1 or batch_size < 1:
+            raise ValueError("concurrency and batch_size must be at least 1")
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.limit = limit
+        self.queue_size = queue_size or 2 * concurrency
+        self.wait_in_flight = wait_in_flight
+
+    def __repr__(self):
+        return (f"<Stage {self.name} concurrency={self.concurrency}"
+                f" batch_size={self.batch_size}>")
+
+    def process(self, items):
+        """
+        Generator. Yields the outputs of the stage for the 'items' iterator
+        (outputs of the previous stage).
+        """
+        units = items if self.batch_size == 1 else \
+            batches(items, self.batch_size)
+        if self.concurrency == 1:
+            outputs = self._serial(units)
+        else:
+            outputs = self._concurrent(iter(units))
+        try:
+            if self.limit is None:
+                yield from outputs
+                return
+            for count, output in enumerate(outputs, 1):
+                yield output
+                if count >= self.limit:
+                    return
+        finally:
+            outputs.close()
+            for upstream in (units, items):
+                if hasattr(upstream, 'close'):
+                    upstream.close()
+
+    def _serial(self, units):
+        for unit in units:
+            yield from self.function(unit) or ()
+
+    def _concurrent(self, units):
+        outputs = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        # the previous stage is pulled by one worker at a time
+        units_lock = threading.Lock()
+        running = [self.concurrency]
+
+        def put(output) -> bool:
+            while not stop.is_set():
+                try:
+                    outputs.put(output, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not stop.is_set():
+                    with units_lock:
+                        unit = next(units, _done)
+                    if unit is _done:
+                        break
+                    for output in self.function(unit) or ():
+                        if not put(output):
+                            return
+            except BaseException as e:
+                put(_Failure(e))
+            finally:
+                with units_lock:
+                    running[0] -= 1
+                    last = not running[0]
+                if last:
+                    put(_done)
+
+        threads = [threading.Thread(target=worker, daemon=True,
+                                    name=f"{self.name}-{i}")
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                output = outputs.get()
+                if output is _done:
+                    return
+                if isinstance(output, _Failure):
+                    raise output.exception
+                yield output
+        finally:
+            # no new item is pulled, requests in flight are finished
+            stop.set()
+            if self.wait_in_flight:
+                for thread in threads:
+                    thread.join()
+
+
+class Pipeline(object):
+    """
+    Stages connected by streaming handoff. Each stage pulls the outputs of
+    the previous one, so nothing is computed before it is needed and the
+    memory is bounded by the batch and queue sizes.
+
+        pipeline = Pipeline(
+            Stage('search', search, concurrency=8),
+            Stage('pick', pick, limit=20),
+            Stage('add', add_tracks, batch_size=100),
+            Stage('persist', write_rows, batch_size=100),
+            )
+        added = pipeline.run(search_words)
+
+    A stage function stops the pipeline by raising StopPipeline.
+    """
+
+    def __init__(self, *stages: Stage):
+        self.stages = stages
+
+    def __repr__(self):
+        return f"<Pipeline {' -> '.join(stage.name for stage in self.stages)}>"
+
+    def stream(self, source):
+        """Generator of the outputs of the last stage."""
+        items = iter(source)
+        for stage in self.stages:
+            items = stage.process(items)
+        return items
+
+    def run(self, source, limit: int = None) -> list:
+        """
+        Argument :
+            source (iterable) : input items of the first stage
+            limit (int)       : stop after this many outputs
+
+        Returns  :
+            outputs (list) : outputs of the last stage
+
+        Raises   :
+            StopPipeline : if a stage stops the pipeline
+        """
+        outputs = self.stream(source)
+        try:
+            return list(islice(outputs, limit))
+        finally:
+            outputs.close()
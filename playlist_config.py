@@ -0,0 +1,48 @@
+"""
+Playlist config of the multi-playlist run mode.
+
+Only the standard library is imported, the Airflow DAG file reads the
+config with this module on every parse without importing spotify_app.
+"""
+import json
+
+
+PLAYLIST_CONFIG_PATH = 'playlists.json'
+
+
+def load_playlist_config(path: str = PLAYLIST_CONFIG_PATH) -> list:
+    """
+    Argument :
+        path (str) : json config file of the multi-playlist run mode
+            {
+                "playlists": [
+                    {"playlist_id": "7xA9OjNeAAaBvZ2WJLHbDT", "target_count": 1},
+                    {"playlist_id": "...", "target_count": 20}
+                ]
+            }
+
+    Returns  :
+        playlists (list) : [{'playlist_id': str, 'target_count': int}, ...]
+                           Empty list if there is no config file.
+
+    Raises   :
+        ValueError : if a playlist_id is listed more than once (the DAG
+                     task ids are built from the playlist ids)
+    """
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return []
+    playlists = []
+    playlist_ids = set()
+    for playlist in config.get('playlists', []):
+        if playlist['playlist_id'] in playlist_ids:
+            raise ValueError(f"playlist_id {playlist['playlist_id']} is"
+                             f" listed more than once in {path}")
+        playlist_ids.add(playlist['playlist_id'])
+        playlists.append({
+            'playlist_id': playlist['playlist_id'],
+            'target_count': int(playlist.get('target_count', 1))
+            })
+    return playlists
@@ -0,0 +1,154 @@
+import random
+import sqlite3
+from collections import defaultdict
+import database_update
+
+
+consonants = "bcçdfgğhjklmnpqrstvwxyz"
+vowels = "aeıioöuü"
+word_lengths = (2, 3, 4, 5)
+
+
+def random_string() -> str:
+    word_len = random.randint(2, 5)
+    word = []
+    for i in range(word_len):
+        if random.random() < 0.5:
+            word.append(random.choice(vowels))
+        else:
+            word.append(random.choice(consonants))
+    return ''.join(word)
+
+
+# probability of a character in random_string, the prior of the model
+base_probability = dict(
+    [(c, 0.5 / len(consonants)) for c in consonants] +
+    [(c, 0.5 / len(vowels)) for c in vowels])
+
+
+class QueryGenerator(object):
+    """
+    Search word generator that learns which words return tracks.
+
+    The outcome of every search (number of the returned tracks) is recorded
+    in the Query_Stats table. 'learn' computes the hit rate of each character
+    bigram ('^' is the word start) and of each word length from this
+    history. 'next_query' samples the characters of a new word from the
+    random_string probabilities weighted by these hit rates.
+
+        queries = QueryGenerator()
+        search_word = queries.next_query()
+        ...
+        queries.record(search_word, len(spochastify.get_tracks(r_search)))
+
+    Argument :
+        exploration (float) : probability of a uniform random_string word,
+                              keeps the words random and the model learning
+        temperature (float) : 1 uses the hit rates as they are, larger
+                              values flatten them (more random), smaller
+                              values sharpen them. Must be positive.
+        prior_strength (float) : number of pseudo attempts with the global
+                                 hit rate added to each bigram
+    """
+
+    def __init__(self, db_path: str = database_update.DB_PATH,
+                 exploration: float = 0.2, temperature: float = 1.0,
+                 prior_strength: float = 5.0):
+        if temperature <= 0:
+            raise ValueError("temperature must be positive")
+        self.db_path = db_path
+        self.exploration = exploration
+        self.temperature = temperature
+        self.prior_strength = prior_strength
+        self.bigram_rates = {}
+        self.length_rates = {}
+        self.global_rate = None
+        self.conn = sqlite3.connect(db_path)
+        database_update.migrate(self.conn)
+        self.learn()
+
+    def record(self, search_word: str, result_count: int) -> None:
+        """Records the outcome of a search. result_count 0 is an empty search."""
+        self.record_many([(search_word, result_count)])
+
+    def record_many(self, outcomes) -> None:
+        """
+        Argument :
+            outcomes (iterable) : (search_word, result_count) pairs,
+                                  written in one transaction
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO Query_Stats"
+                " (search_word, attempts, hits, result_total)"
+                " VALUES (?, 1, ?, ?)"
+                " ON CONFLICT(search_word) DO UPDATE SET"
+                " attempts = attempts + 1,"
+                " hits = hits + excluded.hits,"
+                " result_total = result_total + excluded.result_total",
+                ((search_word, int(result_count > 0), result_count)
+                 for search_word, result_count in outcomes))
+
+    def learn(self) -> None:
+        """Computes the smoothed hit rates from the recorded searches."""
+        bigram_counts = defaultdict(lambda: [0, 0])   # [attempts, hits]
+        length_counts = defaultdict(lambda: [0, 0])
+        total_attempts = total_hits = 0
+        cur = self.conn.execute(
+            "SELECT search_word, attempts, hits FROM Query_Stats")
+        for search_word, attempts, hits in cur:
+            total_attempts += attempts
+            total_hits += hits
+            counts = length_counts[len(search_word)]
+            counts[0] += attempts
+            counts[1] += hits
+            for bigram in zip('^' + search_word, search_word):
+                counts = bigram_counts[bigram]
+                counts[0] += attempts
+                counts[1] += hits
+        if not total_attempts:
+            self.global_rate = None
+            return
+        self.global_rate = (total_hits + 1) / (total_attempts + 2)
+
+        def smoothed(counts):
+            attempts, hits = counts
+            return ((hits + self.prior_strength * self.global_rate)
+                    / (attempts + self.prior_strength))
+
+        self.bigram_rates = {bigram: smoothed(counts)
+                             for bigram, counts in bigram_counts.items()}
+        self.length_rates = {length: smoothed(counts)
+                             for length, counts in length_counts.items()}
+
+    def _weight(self, rate: float) -> float:
+        return (rate / self.global_rate) ** (1 / self.temperature)
+
+    def next_query(self) -> str:
+        """Returns a search word with a high expected hit rate."""
+        if self.global_rate is None or random.random() < self.exploration:
+            return random_string()
+        length_weights = [
+            self._weight(self.length_rates.get(length, self.global_rate))
+            for length in word_lengths]
+        word_len = random.choices(word_lengths, length_weights)[0]
+        characters = list(base_probability)
+        word = []
+        previous = '^'
+        for i in range(word_len):
+            weights = [
+                base_probability[c] * self._weight(
+                    self.bigram_rates.get((previous, c), self.global_rate))
+                for c in characters]
+            previous = random.choices(characters, weights)[0]
+            word.append(previous)
+        return ''.join(word)
+
+    def hit_rate(self) -> float:
+        """Observed share of the searches that returned tracks."""
+        attempts, hits = self.conn.execute(
+            "SELECT SUM(attempts), SUM(hits) FROM Query_Stats").fetchone()
+        return hits / attempts if attempts else 0.0
+
+    def close(self) -> None:
+        self.conn.close()
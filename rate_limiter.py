@@ -0,0 +1,172 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket.
+
+    'rate' tokens are added per second, up to 'capacity' tokens. Each request
+    takes one token; if the bucket is empty 'acquire' sleeps until a token
+    is available. Short bursts up to 'capacity' requests are not delayed.
+    """
+
+    def __init__(self, rate: float = 10.0, capacity: float = 10.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Returns  :
+            waited (float) : seconds slept for the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            # negative tokens are reserved by the threads that are waiting
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def retry_after_seconds(r, default: float = 1.0) -> float:
+    """
+    Argument :
+        r : response object of a 429 response
+
+    Returns  :
+        seconds (float) : Retry-After header value
+                          (delay-seconds or HTTP-date), 'default' if missing
+    """
+    value = r.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, retry_time.timestamp() - time.time())
+
+
+class RequestScheduler(object):
+    """
+    Sends the requests of Tokens and Spochastify instances.
+
+        -> Every request waits for a token of the shared TokenBucket.
+           (requests per second cap)
+        -> 429 Too Many Requests : waits exactly 'Retry-After' seconds and
+           sends the request again. Other threads also wait until then.
+        -> 500, 502, 503, 504    : sends the request again after a jittered
+           exponential backoff. random(0, min(backoff_cap, backoff_base * 2**n))
+           Only idempotent requests (searches, token requests) are retried;
+           a playlist add may be applied by the server before the error
+           response, so it is not sent again.
+
+    After 'max_retries' retries the last response is returned as it is.
+    """
+
+    retry_status_codes = (500, 502, 503, 504)
+
+    def __init__(self, bucket: TokenBucket = None, max_retries: int = 5,
+                 backoff_base: float = 0.5, backoff_cap: float = 30.0):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_if_blocked(self) -> None:
+        with self._lock:
+            delay = self._blocked_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _block_for(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + seconds)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def call(self, f, idempotent: bool = True):
+        """
+        Argument :
+            f : function that sends the request and returns the response
+            idempotent (bool) : retry 5xx responses. 429 responses are
+                                retried in any case (the request is not
+                                processed)
+
+        Returns  :
+            r : response object (exceptions raised by f are not catched)
+
+        r.retries attribute is set to the number of the retries.
+        """
+        attempt = 0
+        while True:
+            self._wait_if_blocked()
+            self.bucket.acquire()
+            r = f()
+            if attempt >= self.max_retries:
+                break
+            if r.status_code == 429:
+                self._block_for(retry_after_seconds(r))
+            elif idempotent and r.status_code in self.retry_status_codes:
+                time.sleep(self.backoff(attempt))
+            else:
+                break
+            r.close()
+            attempt += 1
+        r.retries = attempt
+        return r
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def configure_scheduler(rate: float = 10.0, capacity: float = 10.0,
+                        **kwargs) -> RequestScheduler:
+    """
+    Replaces the shared scheduler.
+
+    >>> configure_scheduler(rate=5, capacity=5, max_retries=3)
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = RequestScheduler(TokenBucket(rate, capacity), **kwargs)
+        return _scheduler
+
+
+def set_scheduler(scheduler: RequestScheduler) -> None:
+    """
+    Replaces the shared scheduler with 'scheduler', e.g. the one returned
+    by 'get_scheduler' before a temporary 'configure_scheduler'.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+def get_scheduler() -> RequestScheduler:
+    """Returns the scheduler shared by all request classes of the process."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import threading
+import time
+from custom_exception_check import json_loads
+
+
+CACHE_PATH = 'search_cache.sql'
+
+sql_cache_create = """
+CREATE TABLE IF NOT EXISTS Search_Cache(
+        cache_key TEXT NOT NULL PRIMARY KEY,
+        body TEXT NOT NULL,
+        created REAL NOT NULL,
+        last_access REAL NOT NULL
+)
+"""
+
+sql_cache_index = """
+CREATE INDEX IF NOT EXISTS idx_search_cache_last_access
+    ON Search_Cache(last_access)
+"""
+
+
+class CachedResponse(object):
+    """
+    Stands in for the requests.models.Response object of a search request
+    that is answered from the SearchCache.
+
+        r.status_code : 200
+        r.json()      : cached search result
+    """
+
+    status_code = 200
+    from_cache = True
+
+    def __init__(self, body: str):
+        self.text = body
+        self._payload = None
+
+    def json(self):
+        if self._payload is None:
+            self._payload = json_loads(self.text)
+        return self._payload
+
+    def release(self) -> None:
+        self._payload = None
+
+
+class SearchCache(object):
+    """
+    On disk LRU cache of search responses.
+
+    Key   : (query, type, limit, market, offset)
+    Value : json body of the search response
+
+    Entries older than 'ttl' seconds are not used. If there are more than
+    'max_entries' entries, the least recently used ones are removed.
+
+        with SearchCache() as cache:
+            spochastify = Spochastify(search_cache=cache)
+
+    The connection is closed on exit (or by 'close').
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = 7 * 24 * 3600,
+                 max_entries: int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(sql_cache_create)
+            self.conn.execute(sql_cache_index)
+
+    @staticmethod
+    def make_key(query: str, search_type: str = 'track', limit=3,
+                 market=None, offset=0) -> str:
+        return json.dumps([query, search_type, str(limit), market or '',
+                           int(offset)],
+                          ensure_ascii=False)
+
+    def get(self, key: str):
+        """
+        Returns  :
+            body (str) : if there is a still valid cached response
+            None       : else
+        """
+        now = time.time()
+        with self._lock, self.conn:
+            row = self.conn.execute(
+                "SELECT body, created FROM Search_Cache WHERE cache_key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            body, created = row
+            if now - created > self.ttl:
+                self.conn.execute(
+                    "DELETE FROM Search_Cache WHERE cache_key = ?", (key,))
+                return None
+            self.conn.execute(
+                "UPDATE Search_Cache SET last_access = ? WHERE cache_key = ?",
+                (now, key))
+            return body
+
+    def put(self, key: str, body: str) -> None:
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO Search_Cache"
+                " (cache_key, body, created, last_access) VALUES (?, ?, ?, ?)",
+                (key, body, now, now))
+            # least recently used entries over the size cap
+            self.conn.execute(
+                "DELETE FROM Search_Cache WHERE cache_key IN"
+                " (SELECT cache_key FROM Search_Cache"
+                "  ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self) -> None:
+        # a search that is still in flight may 'put' from another thread;
+        # after close it raises sqlite3.ProgrammingError in that thread
+        with self._lock:
+            self.conn.close()
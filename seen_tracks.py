@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import struct
+from array import array
+from hashlib import blake2b
+import database_update
+from track_record import NOT_AVAILABLE
+
+
+SEEN_PATH = 'track_request_history.seen'
+
+# file header: magic, version, id of the last Random_Tracks row in the file
+_HEADER = struct.Struct("<4sIq")
+_MAGIC = b"SEEN"
+_VERSION = 1
+
+
+def uri_hash(track_uri: str) -> int:
+    """64 bit hash of a track uri. (8 bytes per track instead of ~50)"""
+    digest = blake2b(track_uri.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class SeenTracks(object):
+    """
+    Membership set of the track uris that are already added to the playlist
+    (Random_Tracks rows), kept as a set of 64 bit hashes.
+
+    The hashes are persisted next to the SQLite file. At startup the file is
+    loaded with one read and only the Random_Tracks rows added after the
+    last save are read from the database (primary key range, no scan).
+
+        seen = SeenTracks.load()
+        unseen_items = [item for item in items if item['uri'] not in seen]
+
+    A hash collision makes an unseen track look seen (probability is about
+    n / 2**64), a seen track is never reported as unseen.
+    """
+
+    def __init__(self, hashes=(), last_rowid: int = 0,
+                 path: str = SEEN_PATH, db_path: str = database_update.DB_PATH):
+        self.hashes = set(hashes)
+        self.last_rowid = last_rowid
+        self.path = path
+        self.db_path = db_path
+
+    @classmethod
+    def load(cls, path: str = SEEN_PATH, db_path: str = database_update.DB_PATH):
+        """Loads the persisted hashes and catches up with the database."""
+        seen = cls(path=path, db_path=db_path)
+        try:
+            with open(path, "rb") as f:
+                magic, version, last_rowid = _HEADER.unpack(
+                                                f.read(_HEADER.size))
+                if magic == _MAGIC and version == _VERSION:
+                    hashes = array("Q")
+                    hashes.frombytes(f.read())
+                    seen.hashes = set(hashes)
+                    seen.last_rowid = last_rowid
+        except (OSError, struct.error, ValueError):
+            # missing, truncated or corrupt file, rebuilt from the database
+            seen = cls(path=path, db_path=db_path)
+        if seen.sync_from_db():
+            seen.save()
+        return seen
+
+    def sync_from_db(self) -> int:
+        """
+        Adds the uris of the Random_Tracks rows with id > last_rowid.
+
+        Returns  :
+            count (int) : number of the new rows
+        """
+        if not os.path.exists(self.db_path):
+            return 0
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cur = conn.execute(
+                "SELECT id, track_uri FROM Random_Tracks WHERE id > ?"
+                " ORDER BY id",
+                (self.last_rowid,))
+            count = 0
+            for rowid, track_uri in cur:
+                if track_uri:
+                    self.hashes.add(uri_hash(track_uri))
+                self.last_rowid = rowid
+                count += 1
+            return count
+        except sqlite3.OperationalError:   # table is not created yet
+            return 0
+        finally:
+            conn.close()
+
+    def save(self) -> None:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.last_rowid))
+            array("Q", self.hashes).tofile(f)
+        os.replace(tmp_path, self.path)
+
+    def add(self, track_uri: str) -> None:
+        self.hashes.add(uri_hash(track_uri))
+
+    def __contains__(self, track_uri: str) -> bool:
+        return uri_hash(track_uri) in self.hashes
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def unseen_items(self, returned_items_list: list) -> list:
+        """Filters the track items of a search result."""
+        return [item for item in returned_items_list or []
+                if item.get('uri') and item['uri'] not in self]
+
+    def unseen_tracks(self, tracks: list) -> list:
+        """Filters track_record.Track records."""
+        return [track for track in tracks
+                if track.track_uri != NOT_AVAILABLE
+                and track.track_uri not in self]
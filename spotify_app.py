@@ -1,9 +1,14 @@
-import random
 import auth
 import api_task_requests
+import search_cache
 from custom_exception_check import trigger_starttime_log
 import database_update
-from datetime import datetime, timezone
+import seen_tracks
+import query_generator
+from playlist_config import PLAYLIST_CONFIG_PATH, load_playlist_config
+from pipeline import Pipeline, StopPipeline
+import track_pipeline
+from outbox import Outbox, OutboxFlusher
 
 
 def get_playlist_id():
@@ -11,105 +16,241 @@ def get_playlist_id():
     return playlist_id
 
 
-def random_string() -> str:
-    consonants = "bcçdfgğhjklmnpqrstvwxyz"
-    vowels = "aeıioöuü"
-    word_len = random.randint(2, 5)
-    word = []
-    for i in range(word_len):
-        if random.random() < 0.5:
-            word.append(random.choice(vowels))
-        else:
-            word.append(random.choice(consonants))
-    return ''.join(word)
+def run_spotify_app(concurrent_searches=0, search_limit=3, playlist_id=None,
+                    selection='search'):
+    """
+    Argument :
+        concurrent_searches (int) : If it is 0, search requests are sent one
+                                    after another (5 attempts). Else, this
+                                    many searches are sent at the same time.
+        search_limit (int)        : number of candidate tracks per search
+                                    request (1-50)
+        playlist_id (str)         : playlist to add the track,
+                                    default is get_playlist_id()
+        selection (str)           : 'search' : random track of a live search
+                                    'corpus' : random unseen track of the
+                                               local Track_Corpus table,
+                                               live search if there is none
+
+    Pipeline (check track_pipeline module):
+        search words -> search -> pick -> enqueue (outbox, 1 track)
+    then the add request and the database insert are sent from the outbox.
+    If a previous run chose a track and failed before both steps were done,
+    that track is resumed instead of a new search.
 
+    Returns  :
+        (track_uri, search_word) : if the track is added
+        (r_search, search_word)  : if no search returned an unseen track
+        r or None                : response object of the failed request,
+                                   None if exception is catched or if the
+                                   add of the track is not confirmed (e.g.
+                                   its outbox entry is out of attempts)
 
-def run_spotify_app():
+    Tracks of the outbox entries that are rejected or out of attempts are
+    not chosen again.
+    """
     # instance for api requests and helper methods
-    spochastify = api_task_requests.Spochastify()
+    # repeated search words are answered from the local search cache
+    cache = search_cache.SearchCache()
+    spochastify = api_task_requests.Spochastify(search_cache=cache)
     # instance for access token requests
     token = auth.Tokens()
-    client_credential_access_token = ''
-    access_token_with_scope = ''
-
-    r = None               # requests.models.Response object
-    r_search = None        # requests.models.Response object
-    r_add_track = None     # requests.models.Response object
-    search_word = ''           # word for track search request
-    returned_items_list = []   # track list retrieved due to search request
-    random_track_uri = None    # track to add to playlist
-    track_details = None       # information about the track
-
-    # adds approximate function call time(GMT 0:00 format) to log file.
-    _ = trigger_starttime_log()
-
-    # 'ACCESS TOKEN' REQUESTS
-    # requesting client credential access token
-    r = token.get_client_credential_access_token()
-    if r is None:   # exception contol such as Connection Error
-        return None
-    # 200: OK - The request has succeeded.
-    elif r.status_code == 200:
-        # 'Access Token' is received
-        client_credential_access_token = r.json()['access_token']
-    else:
-        return r
-
-    # Requesting access token with scope
-    r = token.get_access_token_with_scope()
-    if r is None:   # exception contol such as Connection Error
-        return None
-    # 200: OK - The request has succeeded.
-    if r.status_code == 200:
-        # 'Access Token with scope' is received
-        access_token_with_scope = r.json()['access_token']
-    else:
-        return r
-
-    # 'SEARCH' and 'ADD ITEM' REQUESTS
-    # range(5) is; number of attempts if track list is empty.
-    for i in range(5):
-        # get a random search string
-        search_word = random_string()
-        # Requesting random track search
-        r_search = spochastify.post_search_request(
-                        client_credential_access_token,
-                        search_word
-                        )
-        if r_search is None:   # exception contol such as Connection Error
-            return None
-        # 200: OK - The request has succeeded.
-        elif r_search.status_code == 200:
-            returned_items_list = spochastify.get_list_of_tracks(r_search)
+    # uris of the tracks that are already added, loaded from a local file
+    seen = seen_tracks.SeenTracks.load()
+    # search words with high expected hit rates, learned from past searches
+    queries = query_generator.QueryGenerator()
+    # chosen track and the state of the add and insert steps
+    outbox = Outbox()
+    playlist_id = playlist_id or get_playlist_id()
+    # tracks that the outbox does not send again
+    blocked = outbox.blocked_uris(playlist_id)
+    stages = track_pipeline.TrackStages(spochastify, seen, queries, blocked)
+    try:
+        # adds approximate function call time(GMT 0:00 format) to log file.
+        _ = trigger_starttime_log()
+
+        # 'RESUME' the track of a failed run (e.g. an Airflow retry). It is
+        # not searched again, only the steps that are not done are sent.
+        entries = outbox.incomplete(playlist_id)
+
+        # 'ACCESS TOKEN' REQUEST
+        # access token with scope, requested only if the cached one is
+        # expired. Not needed if the track is added and only the insert is
+        # left. r is None if exception is catched (e.g. Connection Error)
+        access_token_with_scope = None
+        if not entries or any(entry.add_status == 'pending'
+                              for entry in entries):
+            access_token_with_scope, r = \
+                token.get_cached_access_token_with_scope()
+            if access_token_with_scope is None:
+                return r
+
+        if entries:
+            track, search_word = entries[0].track, entries[0].search_word
         else:
-            return r_search
-        # if there is track in track list, pick a random track
-        if returned_items_list:
-            # pick one of the returned items
-            random_track_item = random.choice(returned_items_list)
-            track_details = spochastify.extract_track_info(random_track_item)
-            random_track_uri = track_details['track_uri']
-            break
-    else:
-        # Failed to retrieve any tracks list
-        return (r_search, search_word)
-
-    # requesting item add into the playlist
-    r_add_track = spochastify.add_track_to_playlist(
-                          access_token_with_scope,
-                          random_track_uri,
-                          get_playlist_id()
-                          )
-    if r_add_track is None:   # exception contol such as Connection Error
-        return None
-    # 201: OK - The request has succeeded.
-    elif r_add_track.status_code == 201:
-        # playlist add time. UTC +0
-        dt_now = datetime.now(timezone.utc)
-        # add track details into sql database
-        database_update.update_db(track_details, dt_now)
-        return random_track_uri, search_word
-    else:
-        return r_add_track
-    # successful exit code
-    return 0
+            enqueue = stages.enqueue(outbox, playlist_id, limit=1)
+            # 'TRACK SELECTION' from the local corpus, no search request
+            sampled = None
+            if selection == 'corpus':
+                sampled = database_update.sample_corpus_track(
+                                seen, excluded=blocked)
+            try:
+                if sampled is not None:
+                    picked = Pipeline(enqueue).run([sampled])
+                else:
+                    # 'SEARCH' REQUESTS, live search (fallback of the corpus
+                    # selection). client credential access token,
+                    # requested only if the cached one is expired.
+                    client_credential_access_token, r = \
+                        token.get_cached_client_credential_access_token()
+                    if client_credential_access_token is None:
+                        return r
+                    if concurrent_searches:
+                        # all searches at the same time, failed ones are
+                        # skipped. The first hit is used, the searches
+                        # still in flight are not waited for.
+                        search_words = [queries.next_query()
+                                        for i in range(concurrent_searches)]
+                    else:
+                        # 5 attempts one after another, the next word is
+                        # searched only if the previous result has no new
+                        # track
+                        search_words = (queries.next_query()
+                                        for i in range(5))
+                    search = stages.search(
+                                client_credential_access_token,
+                                search_limit,
+                                concurrency=concurrent_searches or 1,
+                                stop_on_failure=not concurrent_searches)
+                    picked = Pipeline(search, stages.pick(),
+                                      enqueue).run(search_words)
+            except StopPipeline as stop:
+                # failed request (None if exception is catched)
+                return stop.value
+            if not picked:
+                # Failed to retrieve any tracks list
+                return stages.last_search
+            track, search_word = picked[0]
+
+        # 'ADD ITEM' request and 'DB INSERT' of the outbox entries of the
+        # playlist. A failed step stays in the outbox for the next run.
+        flushed = outbox.flush(spochastify, access_token_with_scope,
+                               playlist_id)
+        for chunk in flushed['chunk_results']:
+            if chunk['status_code'] != 201:
+                return chunk['response']
+        entry = outbox.entry(playlist_id, track.track_uri)
+        if entry is None or entry.add_status != 'done':
+            # no add request is sent for the track
+            return None
+        seen.sync_from_db()
+        seen.save()
+        return track.track_uri, search_word
+    finally:
+        cache.close()
+        queries.close()
+        outbox.close()
+
+
+def fill_playlist(playlist_id: str, target_count: int, search_limit=50,
+                  max_searches=None, search_concurrency=1):
+    """
+    Multi-track run mode. Adds 'target_count' random unseen tracks into the
+    playlist with batch requests.
+
+    Argument :
+        playlist_id (str)
+        target_count (int)  : number of tracks to add
+        search_limit (int)  : number of candidate tracks per search (1-50)
+        max_searches (int)  : search attempts, default 5 * target_count
+        search_concurrency (int) : searches in flight
+
+    Pipeline (check track_pipeline module):
+        search words -> search (search_concurrency wide)
+                     -> pick
+                     -> enqueue (outbox, 'target_count' tracks)
+    outbox.OutboxFlusher adds the tracks (100 per request) and writes them
+    to the database in the background.
+
+    Returns  :
+        None or response object : if a token or search request is failed
+        summary (dict) :
+            {
+                'playlist_id': playlist_id,
+                'track_uris': [...],      # added tracks
+                'search_words': [...],
+                'chunk_results': [...]    # Spochastify.add_tracks_to_playlist
+            }                             # results, without 'response'
+
+    Tokens are served from the shared token cache, so the tasks of the
+    playlists do not request a token each.
+    """
+    cache = search_cache.SearchCache()
+    spochastify = api_task_requests.Spochastify(search_cache=cache)
+    token = auth.Tokens()
+    seen = seen_tracks.SeenTracks.load()
+    queries = query_generator.QueryGenerator()
+    outbox = Outbox()
+    stages = track_pipeline.TrackStages(spochastify, seen, queries,
+                                        outbox.blocked_uris(playlist_id))
+    max_searches = max_searches or 5 * target_count
+    try:
+        _ = trigger_starttime_log()
+
+        client_credential_access_token, r = \
+            token.get_cached_client_credential_access_token()
+        if client_credential_access_token is None:
+            return r
+        access_token_with_scope, r = \
+            token.get_cached_access_token_with_scope()
+        if access_token_with_scope is None:
+            return r
+
+        # adds and inserts are sent from the outbox in the background while
+        # the tracks are chosen, pending tracks of failed runs are sent too
+        flusher = OutboxFlusher(outbox, spochastify, access_token_with_scope,
+                                playlist_id).start()
+        search_words = (queries.next_query() for i in range(max_searches))
+        try:
+            Pipeline(
+                stages.search(client_credential_access_token, search_limit,
+                              concurrency=search_concurrency),
+                stages.pick(),
+                stages.enqueue(outbox, playlist_id, flusher,
+                               limit=target_count),
+                ).run(search_words)
+        except StopPipeline as stop:
+            return stop.value
+        finally:
+            flusher.stop()
+            seen.sync_from_db()
+            seen.save()
+    finally:
+        cache.close()
+        queries.close()
+        outbox.close()
+    return {
+        'playlist_id': playlist_id,
+        'track_uris': [track_uri for chunk in flusher.chunk_results
+                       if chunk['status_code'] == 201
+                       for track_uri in chunk['track_uris']],
+        'search_words': [search_word for track, search_word
+                         in stages.picked.values()],
+        # without the response objects, summary is returned to Airflow XCom
+        'chunk_results': [
+            {key: value for key, value in chunk.items() if key != 'response'}
+            for chunk in flusher.chunk_results
+            ]
+        }
+
+
+def run_spotify_app_for_playlists(config_path: str = PLAYLIST_CONFIG_PATH) -> list:
+    """
+    Runs 'fill_playlist' for each playlist in the config file, one after
+    another. (The Airflow DAG runs one task per playlist instead.)
+
+    Returns  :
+        results (list) : return values of fill_playlist
+    """
+    return [fill_playlist(playlist['playlist_id'], playlist['target_count'])
+            for playlist in load_playlist_config(config_path)]
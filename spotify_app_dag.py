@@ -1,8 +1,10 @@
+import importlib
+import os
 from datetime import timedelta
 from airflow import DAG
 from airflow.operators.python_operator import PythonOperator
 from airflow.utils.dates import days_ago
-import spotify_app
+from playlist_config import load_playlist_config
 
 
 default_args = {
@@ -23,10 +25,48 @@ dag = DAG(
     schedule_interval=timedelta(days=1) #how often run, daily
     )
 
-run_etl = PythonOperator(
-    task_id='Task_spotify_app',
-    python_callable = spotify_app.run_spotify_app,
-    dag = dag
+
+def run_by_path(callable_path, **kwargs):
+    """
+    Imports the module of 'callable_path' (e.g. "spotify_app.fill_playlist")
+    when the task runs, not when the scheduler parses this file. The
+    application modules (requests, auth, logging handlers, ...) are not
+    loaded by the DAG parse.
+    """
+    module_name, _, name = callable_path.rpartition('.')
+    return getattr(importlib.import_module(module_name), name)(**kwargs)
+
+
+# multi-playlist run mode: one task per playlist in playlists.json
+# (check playlists.example.json), the tasks run in parallel and share
+# the cached tokens
+playlists = load_playlist_config(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'playlists.json'))
+
+if playlists:
+    run_etl = [
+        PythonOperator(
+            task_id=f"Task_spotify_app_{playlist['playlist_id']}",
+            python_callable=run_by_path,
+            op_kwargs=dict(playlist, callable_path='spotify_app.fill_playlist'),
+            dag=dag
+            )
+        for playlist in playlists
+        ]
+else:
+    run_etl = PythonOperator(
+        task_id='Task_spotify_app',
+        python_callable = run_by_path,
+        op_kwargs = {'callable_path': 'spotify_app.run_spotify_app'},
+        dag = dag
+        )
+
+# metadata and audio features of the added tracks, batched multi-id requests
+enrich_tracks = PythonOperator(
+    task_id='Task_enrich_tracks',
+    python_callable=run_by_path,
+    op_kwargs={'callable_path': 'enrichment.enrich_tracks'},
+    dag=dag
     )
 
-run_etl
+run_etl >> enrich_tracks
@@ -0,0 +1,135 @@
+"""
+Stages of the track pipeline: search -> pick -> enqueue.
+
+spotify_app.run_spotify_app, spotify_app.fill_playlist and
+demo_get_track.run_spotify_app are configurations of these stages
+(check pipeline module). The chosen tracks are added to the playlist and
+written to the database from the outbox (check outbox module).
+
+    stages = TrackStages(spochastify, seen, queries)
+    pipeline = Pipeline(
+        stages.search(client_credential_access_token, concurrency=8),
+        stages.pick(),
+        stages.enqueue(outbox, playlist_id, flusher, limit=20),
+        )
+    picked = pipeline.run(search_words)     # [(Track, search_word), ...]
+"""
+import random
+import threading
+import http_session
+from pipeline import Stage, StopPipeline
+from track_record import Track, NOT_AVAILABLE
+
+
+class TrackStages(object):
+    """
+    Builds the stages and keeps the state shared by them.
+
+    Argument :
+        spochastify : api_task_requests.Spochastify object
+        seen        : seen_tracks.SeenTracks, tracks that are not picked
+                      (optional)
+        queries     : query_generator.QueryGenerator, search outcomes are
+                      recorded (optional)
+        excluded    : other track uris that are not picked, e.g.
+                      outbox.Outbox.blocked_uris (optional)
+
+        self.last_search   : (r_search, search_word) of the last completed
+                             search
+        self.picked        : {track_uri: (Track, search_word)} picked tracks
+    """
+
+    def __init__(self, spochastify, seen=None, queries=None, excluded=()):
+        self.spochastify = spochastify
+        self.seen = seen
+        self.queries = queries
+        self.excluded = excluded
+        self.last_search = (None, '')
+        self.picked = {}
+        self._lock = threading.Lock()
+
+    def search(self, client_credential_access_token: str,
+               search_limit: int = 3, concurrency: int = 1,
+               stop_on_failure: bool = True) -> Stage:
+        """
+        search_word -> (search_word, r_search)
+
+        A failed search stops the pipeline with the response object (None
+        if exception catched) when 'stop_on_failure' is True. Otherwise it
+        is skipped.
+
+        With concurrency > 1 the pipeline returns as soon as the later
+        stages have enough tracks; the searches still in flight are not
+        waited for and their results are dropped.
+        """
+        if http_session.session_config["pool_maxsize"] < concurrency:
+            http_session.configure_session(pool_maxsize=concurrency)
+
+        def search(search_word):
+            r_search = self.spochastify.post_search_request(
+                            client_credential_access_token,
+                            search_word,
+                            limit=search_limit
+                            )
+            with self._lock:
+                self.last_search = (r_search, search_word)
+            # 200: OK - The request has succeeded.
+            if r_search is not None and r_search.status_code == 200:
+                return [(search_word, r_search)]
+            if stop_on_failure:
+                raise StopPipeline(r_search)
+            return None
+        return Stage('search', search, concurrency=concurrency,
+                     wait_in_flight=False)
+
+    def pick(self, limit: int = None) -> Stage:
+        """
+        (search_word, r_search) -> (Track, search_word)
+
+        Records the search outcome (number of the tracks on the result
+        page, as the harvester does) and picks one random unseen track of
+        the page (None if there is no such track). A response of the search
+        cache is not recorded again. Runs in the consuming thread; the query
+        generator connection is not shared between threads.
+        """
+        def pick(result):
+            search_word, r_search = result
+            items = self.spochastify.get_list_of_tracks(r_search) or []
+            if self.queries is not None \
+                    and not getattr(r_search, 'from_cache', False):
+                self.queries.record(search_word, len(items))
+            if self.seen is not None:
+                # tracks that are already added are not picked again
+                items = self.seen.unseen_items(items)
+            tracks = [track for track in map(Track.from_item, items)
+                      if track.track_uri != NOT_AVAILABLE
+                      and track.track_uri not in self.picked
+                      and track.track_uri not in self.excluded]
+            if not tracks:
+                return None
+            track = random.choice(tracks)
+            self.picked[track.track_uri] = (track, search_word)
+            return [(track, search_word)]
+        return Stage('pick', pick, limit=limit)
+
+    def enqueue(self, outbox, playlist_id: str, flusher=None,
+                limit: int = None) -> Stage:
+        """
+        (Track, search_word) -> (Track, search_word)
+
+        Records the chosen track in the outbox (outbox.Outbox). The add and
+        insert steps are sent from the outbox, by 'flusher'
+        (outbox.OutboxFlusher) in the background when it is given.
+
+        A track that is already in the outbox (of any playlist, check
+        Outbox.put) is not recorded again and has no output, so it does not
+        count toward 'limit'.
+        """
+        def enqueue(picked):
+            track, search_word = picked
+            if not outbox.put(playlist_id, track, search_word):
+                return None
+            if flusher is not None:
+                flusher.notify()
+            return [picked]
+        return Stage('enqueue', enqueue, limit=limit)
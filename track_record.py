@@ -0,0 +1,56 @@
+from typing import NamedTuple
+
+
+NOT_AVAILABLE = 'Not Available'
+
+
+class Track(NamedTuple):
+    """
+    Compact record of the track fields that are used by the application.
+    (a tuple, no per-instance __dict__)
+
+    Field order is the column order of the Random_Tracks table and
+    field names are the keys of the 'extract_track_info' dict.
+    """
+    artist_name: str
+    album_name: str
+    track_name: str
+    track_external_urls: str
+    track_uri: str
+
+    @classmethod
+    def from_item(cls, item: dict) -> 'Track':
+        """
+        Argument :
+            item (dict) : a track item of a search result
+                          r_search.json()['tracks']['items'][i]
+
+        Missing fields are 'Not Available'.
+        """
+        try:
+            artist_name = item['artists'][0]['name']
+        except (KeyError, IndexError):
+            artist_name = NOT_AVAILABLE
+        album_name = item.get('album', {}).get('name', NOT_AVAILABLE)
+        external_urls = item.get('external_urls', {})
+        return cls(artist_name,
+                   album_name,
+                   item.get('name', NOT_AVAILABLE),
+                   external_urls.get('spotify', NOT_AVAILABLE),
+                   item.get('uri', NOT_AVAILABLE))
+
+
+def extract_many(items) -> list:
+    """
+    Projects the needed fields out of a whole search page at once.
+    The item dicts (with 'available_markets' lists etc.) can be dropped
+    right after the projection.
+
+    Argument :
+        items (iterable) : track items of a search result
+
+    Returns  :
+        tracks (list) : Track records
+    """
+    from_item = Track.from_item
+    return [from_item(item) for item in items or ()]